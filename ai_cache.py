@@ -0,0 +1,143 @@
+"""
+Bounded cache for AI responses.
+
+Entries are evicted least-recently-used once the cache holds too many entries or bytes,
+and expire after a fixed time-to-live. Keys are normalized so "Hi" and "hi " share an entry,
+and are scoped per guild and prompt when a guild has its own AI prompt. Changes are collected and written
+to storage in batches instead of rewriting the whole cache on every miss.
+"""
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+GLOBAL_SCOPE = "global"
+
+# Sentence punctuation around the prompt; punctuation inside it ("2+2", "C++") is kept
+_EDGE_PUNCTUATION = re.compile(r"^[\s.,!?;:'\"…]+|[\s.,!?;:'\"…]+$")
+_SCOPED_KEY = re.compile(r"^(global|\d+(-[0-9a-f]{8})?):")
+
+
+def normalize_prompt(text):
+    """Lowercases, strips punctuation at the start and end and collapses whitespace."""
+    return " ".join(_EDGE_PUNCTUATION.sub("", text.lower()).split())
+
+
+def prompt_scope(guild_id, system_prompt):
+    """Scope for a guild's own AI prompt; changing the prompt starts a fresh scope."""
+    return f"{guild_id}-{hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()[:8]}"
+
+
+def make_key(text, scope=GLOBAL_SCOPE):
+    """Builds the cache key for a prompt within a scope ("global" or a guild's prompt_scope())."""
+    return f"{scope}:{normalize_prompt(text)}"
+
+
+def _entry_size(key, response):
+    return len(key.encode("utf-8")) + len(response.encode("utf-8"))
+
+
+class AICache:
+    def __init__(self, max_entries=5000, max_bytes=5_000_000, ttl=7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (response, created_at), oldest use first
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        # Changes not yet written to storage
+        self._dirty = set()
+        self._deleted = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, rows):
+        """Fills the cache from storage rows ({key: {"response", "created_at"}}), upgrading old unscoped keys."""
+        now = time.time()
+        for key, row in sorted(rows.items(), key=lambda item: item[1]["created_at"]):
+            if now - row["created_at"] > self.ttl:
+                self._deleted.add(key)
+                continue
+
+            if not _SCOPED_KEY.match(key):
+                # Entries saved before keys were normalized and scoped
+                self._deleted.add(key)
+                new_key = make_key(key)
+                self._dirty.add(new_key)
+            else:
+                new_key = key
+
+            self._store(new_key, row["response"], row["created_at"])
+
+    def get(self, key):
+        """Returns the cached response or None, counting the hit or miss."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        response, created_at = entry
+        if time.time() - created_at > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, key, response):
+        self._store(key, response, time.time())
+        self._dirty.add(key)
+        self._deleted.discard(key)
+
+    def _store(self, key, response, created_at):
+        if key in self._entries:
+            old_response, _ = self._entries.pop(key)
+            self._bytes -= _entry_size(key, old_response)
+
+        self._entries[key] = (response, created_at)
+        self._bytes += _entry_size(key, response)
+
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key):
+        response, _ = self._entries.pop(key)
+        self._bytes -= _entry_size(key, response)
+        self._dirty.discard(key)
+        self._deleted.add(key)
+
+    def take_pending(self):
+        """Returns (rows to upsert, keys to delete) since the last call and resets them."""
+        rows = {
+            key: {"response": self._entries[key][0], "created_at": self._entries[key][1]}
+            for key in self._dirty
+        }
+        deleted = list(self._deleted)
+        self._dirty.clear()
+        self._deleted.clear()
+        return rows, deleted
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
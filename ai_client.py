@@ -0,0 +1,286 @@
+"""
+Helpers that sit in front of the AI upstream: pooled API clients, request coalescing,
+client-side rate limiting and retries.
+"""
+import asyncio
+import json
+import random
+from collections import OrderedDict, deque
+
+import aiohttp
+
+from ratelimit import TokenBucket
+
+
+class AIClient:
+    """Long-lived client for one OpenAI-compatible API, with its own keep-alive connection pool."""
+
+    def __init__(self, base_url, api_key, pool_size=20, keepalive_timeout=60, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=5)
+        self._session = None
+
+    def session(self):
+        """Returns the client's session, creating it on first use. Must be called from the event loop."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+            )
+        return self._session
+
+    async def chat(self, model, messages, **params):
+        """Returns the text of a chat completion. Raises aiohttp.ClientResponseError on HTTP errors."""
+        payload = {"model": model, "messages": messages, **params}
+        async with self.session().post(f"{self.base_url}/chat/completions", json=payload) as r:
+            # The error message includes the status code (e.g. 429)
+            r.raise_for_status()
+            completion = await r.json()
+        return completion["choices"][0]["message"]["content"]
+
+    async def stream_chat(self, model, messages, **params):
+        """Yields pieces of a chat completion as the server streams them (server-sent events)."""
+        payload = {"model": model, "messages": messages, "stream": True, **params}
+        async with self.session().post(f"{self.base_url}/chat/completions", json=payload) as r:
+            r.raise_for_status()
+            async for raw_line in r.content:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+
+                choices = json.loads(data).get("choices") or []
+                if choices:
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        yield delta
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class AIClientManager:
+    """Creates AI clients lazily and keeps one per (base URL, API key) for the life of the bot."""
+
+    def __init__(self, pool_size=20, keepalive_timeout=60, timeout=60):
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._clients = {}
+
+    def get(self, base_url, api_key):
+        client = self._clients.get((base_url, api_key))
+        if client is None:
+            client = AIClient(base_url, api_key, self.pool_size, self.keepalive_timeout, self.timeout)
+            self._clients[(base_url, api_key)] = client
+        return client
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.close()
+        self._clients.clear()
+
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one in-flight call instead of each making their own."""
+
+    def __init__(self):
+        self._calls = {}
+        # number of callers that were served by someone else's call
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, func):
+        """Awaits func() once per key at a time; callers arriving while it runs get the same result or error."""
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+
+        # Shield the shared call so one caller being cancelled doesn't cancel it for everyone else
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the error as retrieved even if every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+
+class AIQueueFull(Exception):
+    """Raised when the AI wait queue has no room for another request."""
+
+
+def _is_retryable(error):
+    return isinstance(error, aiohttp.ClientResponseError) and (error.status == 429 or error.status >= 500)
+
+
+def _retry_after(error):
+    try:
+        return float(error.headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+async def call_with_retry(func, max_retries=3, base_delay=1.0, max_delay=30.0):
+    """Awaits func(), retrying 429 and 5xx responses with jittered exponential backoff."""
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except Exception as e:
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            # Honor Retry-After when the upstream sends it, otherwise use "full jitter" backoff
+            delay = _retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+def _copy_result(task, future):
+    if future.done():
+        if not task.cancelled():
+            task.exception()
+        return
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+
+class AIScheduler:
+    """
+    Paces AI calls with a global and a per-guild token bucket.
+
+    Calls that can't start right away wait in a bounded queue. Guilds are served round-robin,
+    so one busy guild can't starve the others.
+    """
+
+    def __init__(self, global_rate=1.0, global_burst=5, guild_rate=0.2, guild_burst=3,
+                 max_queue=50, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+
+        self._guild_buckets = {}
+        # guild_id -> deque of (func, future); dict order is the round-robin order
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        # Running upstream calls
+        self._tasks = set()
+
+        self.started = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return self._queued
+
+    def _guild_bucket(self, guild_id):
+        bucket = self._guild_buckets.get(guild_id)
+        if bucket is None:
+            bucket = self._guild_buckets[guild_id] = TokenBucket(self.guild_rate, self.guild_burst)
+        return bucket
+
+    def submit(self, guild_id, func):
+        """
+        Schedules func() for a guild and returns (future, position).
+        Position 0 means the call started right away. Raises AIQueueFull if the queue is full.
+        """
+        future = asyncio.get_running_loop().create_future()
+        guild_bucket = self._guild_bucket(guild_id)
+
+        if not self._queued and self.global_bucket.time_until() == 0 and guild_bucket.time_until() == 0:
+            self.global_bucket.take()
+            guild_bucket.take()
+            self._start(func, future)
+            return future, 0
+
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise AIQueueFull(f"AI queue is full ({self.max_queue} waiting)")
+
+        self._queues.setdefault(guild_id, deque()).append((func, future))
+        self._queued += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        self._wakeup.set()
+        return future, self._queued
+
+    def _start(self, func, future):
+        self.started += 1
+        task = asyncio.ensure_future(call_with_retry(func, self.max_retries))
+        # Referenced until done, so the call can't be garbage collected mid-flight
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda done: _copy_result(done, future))
+
+    async def _dispatch(self):
+        while True:
+            if not self._queued:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            wait = self._start_next()
+            if wait:
+                await asyncio.sleep(wait)
+
+    def _start_next(self):
+        """Starts the next queued call in guild order; returns how long to wait if none can start yet."""
+        global_wait = self.global_bucket.time_until()
+        if global_wait:
+            return global_wait
+
+        waits = []
+        for guild_id in list(self._queues):
+            bucket = self._guild_buckets[guild_id]
+            guild_wait = bucket.time_until()
+            if guild_wait:
+                waits.append(guild_wait)
+                continue
+
+            # Take the guild's oldest call and move the guild to the back of the line
+            queue = self._queues.pop(guild_id)
+            func, future = queue.popleft()
+            if queue:
+                self._queues[guild_id] = queue
+            self._queued -= 1
+
+            # The caller gave up while waiting, don't spend tokens on it
+            if future.cancelled():
+                return 0
+
+            self.global_bucket.take()
+            bucket.take()
+            self._start(func, future)
+            return 0
+
+        return min(waits)
@@ -0,0 +1,117 @@
+"""
+Flags blocking calls (synchronous sleep, file, network, database or process I/O) inside coroutines.
+
+One blocking call in a command or event handler freezes the bot in every guild until it returns,
+so run this before committing. Code inside nested regular functions and lambdas is not checked,
+since it usually runs elsewhere (in an executor, or later). A call that is known to be cheap can be
+allowed by ending its line with "# blocking: ok".
+
+Calls on the storage backend count as blocking too: SQLite can wait up to its busy timeout for
+another process. The JSON backend only blocks on reads of files it hasn't loaded yet.
+
+Runs as part of the test suite (tests/test_check_blocking.py).
+
+Usage:
+    python check_blocking.py [files...]    Checks the given files, or every .py file in this folder
+"""
+import ast
+import glob
+import os
+import sys
+
+# Calls that block the event loop, as written in the source
+BLOCKING_CALLS = {
+    "time.sleep", "open", "input",
+    "os.system", "os.popen", "os.wait", "os.waitpid",
+    "subprocess.run", "subprocess.call", "subprocess.check_call", "subprocess.check_output",
+    "socket.create_connection", "urllib.request.urlopen", "urlopen",
+    "json.load", "json.dump", "shutil.copy", "shutil.copyfile", "shutil.move",
+}
+# Any call on these modules blocks (requests.get, requests.post, ...)
+BLOCKING_MODULES = {"requests", "urllib3", "httpx", "sqlite3"}
+# Any method call on these objects blocks (storage.load_settings(), self.conn.execute(), ...)
+BLOCKING_OBJECTS = {"storage", "self.storage", "self.conn"}
+
+ALLOW_COMMENT = "# blocking: ok"
+
+
+def _call_name(node):
+    """Returns the dotted name of a call like time.sleep(...), or None for anything fancier."""
+    parts = []
+    func = node.func
+    while isinstance(func, ast.Attribute):
+        parts.append(func.attr)
+        func = func.value
+    if not isinstance(func, ast.Name):
+        return None
+    parts.append(func.id)
+    return ".".join(reversed(parts))
+
+
+def _is_blocking(name):
+    return (name in BLOCKING_CALLS or name.split(".")[0] in BLOCKING_MODULES
+            or name.rpartition(".")[0] in BLOCKING_OBJECTS)
+
+
+class _Checker(ast.NodeVisitor):
+    def __init__(self, path, lines):
+        self.path = path
+        self.lines = lines
+        self.coroutines = []
+        self.problems = []
+
+    def visit_AsyncFunctionDef(self, node):
+        self.coroutines.append(node.name)
+        self.generic_visit(node)
+        self.coroutines.pop()
+
+    def visit_FunctionDef(self, node):
+        # A regular function defined inside a coroutine doesn't run as part of it
+        saved, self.coroutines = self.coroutines, []
+        self.generic_visit(node)
+        self.coroutines = saved
+
+    def visit_Lambda(self, node):
+        saved, self.coroutines = self.coroutines, []
+        self.generic_visit(node)
+        self.coroutines = saved
+
+    def visit_Call(self, node):
+        name = _call_name(node)
+        if self.coroutines and name and _is_blocking(name):
+            if not self.lines[node.lineno - 1].rstrip().endswith(ALLOW_COMMENT):
+                self.problems.append(f"{self.path}:{node.lineno}: {name}() blocks the event loop in {self.coroutines[-1]}()")
+        self.generic_visit(node)
+
+
+def check_file(path):
+    """Returns a list of problems found in one file."""
+    with open(path, encoding="utf-8") as f:
+        return check_source(f.read(), path)
+
+
+def check_source(source, path="<source>"):
+    checker = _Checker(path, source.splitlines())
+    checker.visit(ast.parse(source, path))
+    return checker.problems
+
+
+def main(paths):
+    if not paths:
+        here = os.path.dirname(os.path.abspath(__file__))
+        paths = sorted(glob.glob(os.path.join(here, "*.py")))
+
+    problems = []
+    for path in paths:
+        problems.extend(check_file(path))
+
+    for problem in problems:
+        print(f"❌ {problem}")
+    if problems:
+        return 1
+    print(f"✅ No blocking calls found in coroutines ({len(paths)} files checked).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
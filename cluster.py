@@ -0,0 +1,158 @@
+"""
+Runs the bot as several processes, each connecting its own share of the shards, all sharing one
+SQLite database.
+
+Each process is started as `python main.py` with SHARD_COUNT, SHARD_IDS and CLUSTER_ID set, and is
+restarted (with a growing delay) if it crashes. Ctrl+C stops all of them.
+
+Usage:
+    python cluster.py [processes] [shards]    Defaults: one process per CPU core, Discord's recommended shard count
+    python cluster.py status [database]       Shows the last health report of every shard
+"""
+import asyncio
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from storage import DATABASE_FILE, SqliteBackend
+
+# Discord lets a bot start (identify) max_concurrency shards every 5 seconds
+IDENTIFY_INTERVAL = 5
+
+
+async def _gateway_info(token):
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot",
+                               headers={"Authorization": f"Bot {token}"}) as r:
+            r.raise_for_status()
+            return await r.json()
+
+
+def recommended_shards(token):
+    """Returns (shard count, max concurrency) as recommended by Discord for this bot."""
+    info = asyncio.run(_gateway_info(token))
+    return info["shards"], info.get("session_start_limit", {}).get("max_concurrency", 1)
+
+
+def split_shards(shard_count, processes):
+    """Deals shard ids out to the processes: [[0, 3, 6], [1, 4, 7], [2, 5]] for 8 shards and 3 processes."""
+    return [list(range(cluster_id, shard_count, processes)) for cluster_id in range(processes)]
+
+
+class Cluster:
+    def __init__(self, shard_count, processes, max_concurrency=1):
+        self.shard_count = shard_count
+        self.assignments = [shard_ids for shard_ids in split_shards(shard_count, processes) if shard_ids]
+        self.max_concurrency = max_concurrency
+        self.metrics_port = int(os.getenv("METRICS_PORT", "9100"))
+        self.processes = {}
+        self.restarts = {}
+        self.stopping = False
+
+    def _env(self, cluster_id):
+        env = dict(os.environ)
+        env.update({
+            "SHARD_COUNT": str(self.shard_count),
+            "SHARD_IDS": ",".join(map(str, self.assignments[cluster_id])),
+            "CLUSTER_ID": str(cluster_id),
+            "STORAGE_BACKEND": "sqlite",
+            "SHARED_STORAGE": "1",
+            # Each process gets its own metrics port
+            "METRICS_PORT": str(self.metrics_port + cluster_id if self.metrics_port else 0),
+        })
+        return env
+
+    def start(self, cluster_id):
+        shard_ids = self.assignments[cluster_id]
+        self.processes[cluster_id] = subprocess.Popen([sys.executable, "main.py"], env=self._env(cluster_id))
+        print(f"✅ Started cluster {cluster_id} (pid {self.processes[cluster_id].pid}) with shards {shard_ids}")
+
+    def start_all(self):
+        for cluster_id, shard_ids in enumerate(self.assignments):
+            if self.stopping:
+                return
+            self.start(cluster_id)
+            # Give this process time to identify its shards before the next one starts
+            if cluster_id < len(self.assignments) - 1:
+                time.sleep(math.ceil(len(shard_ids) / self.max_concurrency) * IDENTIFY_INTERVAL)
+
+    def supervise(self):
+        """Restarts processes that exit, until stop() is called."""
+        next_start = {}
+        while not self.stopping:
+            now = time.monotonic()
+            for cluster_id, process in list(self.processes.items()):
+                if process.poll() is None or self.stopping:
+                    continue
+                if cluster_id not in next_start:
+                    restarts = self.restarts.get(cluster_id, 0)
+                    delay = min(60, 2 ** restarts)
+                    print(f"❌ Cluster {cluster_id} exited with code {process.returncode}, restarting in {delay}s")
+                    next_start[cluster_id] = now + delay
+                elif now >= next_start.pop(cluster_id):
+                    self.restarts[cluster_id] = self.restarts.get(cluster_id, 0) + 1
+                    self.start(cluster_id)
+            time.sleep(1)
+
+    def stop(self, *_):
+        self.stopping = True
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def print_status(database):
+    storage = SqliteBackend(database)
+    rows = storage.load_shard_health()
+    storage.close()
+    if not rows:
+        print("No shard has reported yet.")
+        return
+
+    now = time.time()
+    for row in rows:
+        age = now - row["updated_at"]
+        latency = f"{row['latency'] * 1000:.0f}ms" if row["latency"] is not None else "?"
+        print(f"shard {row['shard_id']:>3} | cluster {row['cluster_id']:>2} | pid {row['pid']:>7} | {row['status']:<12} | "
+              f"{row['guilds']:>6} guilds | {latency:>6} | reported {age:.0f}s ago")
+    print(f"{sum(row['guilds'] for row in rows)} guilds on {len(rows)} shards")
+
+
+def main(args):
+    if args and args[0] == "status":
+        print_status(args[1] if len(args) > 1 else os.getenv("STORAGE_DB", DATABASE_FILE))
+        return 0
+
+    processes = int(args[0]) if args else os.cpu_count() or 1
+    max_concurrency = 1
+    if len(args) > 1:
+        shard_count = int(args[1])
+    else:
+        shard_count, max_concurrency = recommended_shards(os.getenv("DISCORD_TOKEN"))
+        print(f"✅ Discord recommends {shard_count} shards")
+
+    if not os.path.exists(os.getenv("STORAGE_DB", DATABASE_FILE)):
+        print("⚠ No SQLite database yet. To keep existing data, stop here and run `python storage.py migrate` first.")
+
+    cluster = Cluster(shard_count, min(processes, shard_count), max_concurrency)
+    signal.signal(signal.SIGTERM, cluster.stop)
+    try:
+        cluster.start_all()
+        cluster.supervise()
+    except KeyboardInterrupt:
+        cluster.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,125 @@
+"""
+Compiled per-guild dispatch tables for custom commands added with ;addcommand.
+
+Each guild's commands (and their aliases) are compiled into one dict, and each response
+template is split into literal text and placeholder slots ahead of time. Handling a message
+is then one dict lookup, and a hit is filling the slots and one join.
+
+Stored command formats (in the guild's "custom_commands" setting):
+    "name": "response"
+    "name": {"response": "...", "aliases": ["other"], "cooldown": seconds}
+
+Templates can use {user.mention}, {user.name} and {args} (the text after the command name).
+A command whose response uses {args} also matches when the message has text after its name.
+"""
+import re
+import time
+
+_PLACEHOLDER = re.compile(r"\{(user\.mention|user\.name|args)\}")
+
+
+class Template:
+    __slots__ = ("parts", "slots")
+
+    def __init__(self, text):
+        # parts holds literal text with None where a placeholder goes; slots are (index, placeholder)
+        self.parts = []
+        self.slots = []
+        position = 0
+        for match in _PLACEHOLDER.finditer(text):
+            if match.start() > position:
+                self.parts.append(text[position:match.start()])
+            self.slots.append((len(self.parts), match.group(1)))
+            self.parts.append(None)
+            position = match.end()
+        if position < len(text):
+            self.parts.append(text[position:])
+
+    def uses(self, placeholder):
+        return any(name == placeholder for _, name in self.slots)
+
+    def render(self, values):
+        if not self.slots:
+            return "".join(self.parts)
+        parts = self.parts.copy()
+        for index, name in self.slots:
+            parts[index] = values[name]
+        return "".join(parts)
+
+
+class CustomCommand:
+    __slots__ = ("name", "template", "takes_args", "cooldown", "last_used")
+
+    def __init__(self, name, response, cooldown=0):
+        self.name = name
+        self.template = Template(response)
+        self.takes_args = self.template.uses("args")
+        self.cooldown = cooldown
+        # user id -> when they last used the command; only touched on a hit
+        self.last_used = {}
+
+    def on_cooldown(self, user_id):
+        """Returns True if the user must wait, otherwise records this use."""
+        if not self.cooldown:
+            return False
+        now = time.monotonic()
+        if now - self.last_used.get(user_id, -self.cooldown) < self.cooldown:
+            return True
+        self.last_used[user_id] = now
+        return False
+
+    def render(self, author, args=""):
+        return self.template.render({"user.mention": author.mention, "user.name": author.name, "args": args})
+
+
+def normalize_command(value):
+    """Returns a stored command as {"response", "aliases", "cooldown"}."""
+    if isinstance(value, dict):
+        return {"response": value.get("response", ""), "aliases": list(value.get("aliases", [])),
+                "cooldown": value.get("cooldown", 0)}
+    return {"response": value, "aliases": [], "cooldown": 0}
+
+
+class CustomCommandIndex:
+    def __init__(self):
+        # guild_id -> {name or alias: CustomCommand}
+        self.tables = {}
+
+    def rebuild(self, settings):
+        for guild_id in set(self.tables) - {str(guild_id) for guild_id in settings}:
+            del self.tables[guild_id]
+        for guild_id, guild_settings in settings.items():
+            self.rebuild_guild(guild_id, guild_settings)
+
+    def rebuild_guild(self, guild_id, guild_settings):
+        """Recompiles one guild's table; called when its custom commands change."""
+        table = {}
+        old_table = self.tables.get(str(guild_id), {})
+        for name, value in guild_settings.get("custom_commands", {}).items():
+            config = normalize_command(value)
+            command = CustomCommand(name, config["response"], config["cooldown"])
+            # Keep who used the command when, so a reload doesn't reset cooldowns
+            old = old_table.get(name)
+            if old is not None and old.name == name:
+                command.last_used = old.last_used
+            for alias in config["aliases"]:
+                table.setdefault(alias, command)
+            table[name] = command
+
+        if table:
+            self.tables[str(guild_id)] = table
+        else:
+            self.tables.pop(str(guild_id), None)
+
+    def match(self, table, content):
+        """Returns (command, args) for a message in a guild's table, or (None, None)."""
+        command = table.get(content)
+        if command is not None:
+            return command, ""
+
+        name, _, args = content.partition(" ")
+        if args:
+            command = table.get(name)
+            if command is not None and command.takes_args:
+                return command, args.strip()
+        return None, None
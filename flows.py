@@ -0,0 +1,97 @@
+"""
+Multi-step admin flows (server setup, tickets) that run on the event loop without blocking it.
+
+A Flow is a list of named steps, each an async function that may depend on earlier steps.
+Steps whose dependencies are done run concurrently, and progress is shown by editing a
+single status message instead of sending one message per step.
+"""
+import asyncio
+
+import discord
+
+PENDING, RUNNING, DONE, FAILED, SKIPPED = "⬜", "⏳", "✅", "❌", "⏭️"
+
+
+class Step:
+    def __init__(self, name, func, after):
+        self.name = name
+        self.func = func
+        self.after = after
+        self.state = PENDING
+        self.detail = ""
+        self.result = None
+
+
+class Flow:
+    def __init__(self, title):
+        self.title = title
+        self.steps = {}
+        self.status_message = None
+        self._edit_lock = asyncio.Lock()
+
+    def step(self, name, after=()):
+        """
+        Decorator that adds a step. The function is called with the results of the steps it comes
+        after, in order, and may return a short string to show next to the step or a result for later steps.
+        """
+        def decorator(func):
+            self.steps[name] = Step(name, func, tuple(after))
+            return func
+        return decorator
+
+    def render(self, footer=""):
+        lines = [f"**{self.title}**"]
+        for step in self.steps.values():
+            lines.append(f"{step.state} {step.name}" + (f" – {step.detail}" if step.detail else ""))
+        if footer:
+            lines.append(footer)
+        return "\n".join(lines)
+
+    async def _show(self, footer=""):
+        # Edits can finish out of order when steps run concurrently, so send them one at a time
+        async with self._edit_lock:
+            try:
+                await self.status_message.edit(content=self.render(footer))
+            except discord.DiscordException as e:
+                print(f"❌ Error updating status for '{self.title}': {str(e)}")
+
+    async def _run_step(self, step, started):
+        # Wait for the steps this one comes after
+        dependencies = [self.steps[name] for name in step.after]
+        await asyncio.gather(*(started[name] for name in step.after))
+
+        if any(dependency.state != DONE for dependency in dependencies):
+            step.state = SKIPPED
+            await self._show()
+            return
+
+        # Only finished steps edit the status message, Discord limits how often a message can be edited
+        step.state = RUNNING
+        try:
+            step.result = await step.func(*(dependency.result for dependency in dependencies))
+            step.state = DONE
+            if isinstance(step.result, str):
+                step.detail = step.result
+        except Exception as e:
+            step.state = FAILED
+            step.detail = str(e)
+            print(f"❌ '{self.title}' step '{step.name}' failed: {str(e)}")
+        await self._show()
+
+    async def run(self, channel):
+        """Runs every step, showing progress in one message in `channel`. Returns whether all steps succeeded."""
+        self.status_message = await channel.send(self.render())
+
+        started = {}
+        for step in self.steps.values():
+            started[step.name] = asyncio.ensure_future(self._run_step(step, started))
+        await asyncio.gather(*started.values())
+
+        return all(step.state == DONE for step in self.steps.values())
+
+    async def finish(self, footer):
+        """Adds a closing line under the steps."""
+        await self._show(footer)
+
+    def result(self, name):
+        return self.steps[name].result
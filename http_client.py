@@ -0,0 +1,38 @@
+"""
+Shared async HTTP session used by every web API integration (Tenor, Pixabay, TheCatAPI and the AI API).
+
+One pooled session keeps connections alive between calls, so a request doesn't pay for a new
+TCP/TLS handshake, and nothing blocks the Discord event loop while an upstream is slow.
+"""
+import aiohttp
+
+# Connection pool limits and timeouts (seconds)
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 10
+KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5, sock_read=25)
+
+_session = None
+
+
+def get_session():
+    """Returns the shared session, creating it on first use. Must be called from the event loop."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=DNS_CACHE_TTL,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT)
+    return _session
+
+
+async def close_session():
+    """Closes the shared session and its pooled connections."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -0,0 +1,212 @@
+"""
+Member joins: welcome messages and auto roles, built to survive raids and big invite waves.
+
+JoinTargets remembers each guild's resolved welcome channel and auto role, so a join doesn't scan
+the guild's channels and roles. WelcomeBatcher folds the joins of a short window into one welcome
+message, and AutoRoleQueue hands out auto roles from a bounded queue at a pace Discord accepts.
+"""
+import asyncio
+import random
+import time
+
+import discord
+
+from ratelimit import TokenBucket
+
+
+class JoinTargets:
+    """Caches the welcome channel and auto role of each guild until its settings or channels/roles change."""
+
+    def __init__(self, ttl=300):
+        # Permissions can change without an event we listen to, so re-resolve every `ttl` seconds anyway
+        self.ttl = ttl
+        # guild_id -> (settings key, channel id, role id, resolved at)
+        self._targets = {}
+        self.resolves = 0
+
+    def invalidate(self, guild_id):
+        self._targets.pop(guild_id, None)
+
+    def resolve(self, guild, guild_settings):
+        """Returns (channel, role) for new members of the guild; either may be None."""
+        key = (guild_settings.get("Welcome Channel"), guild_settings.get("Auto Role"))
+        cached = self._targets.get(guild.id)
+        if cached and cached[0] == key and time.monotonic() - cached[3] < self.ttl:
+            _, channel_id, role_id, _ = cached
+            channel = guild.get_channel(channel_id) if channel_id else None
+            role = guild.get_role(role_id) if role_id else None
+            # Deleted since it was cached
+            if (channel is not None or not channel_id) and (role is not None or not role_id):
+                return channel, role
+
+        channel = self._find_channel(guild, key[0])
+        role = self._find_role(guild, key[1])
+        self.resolves += 1
+        self._targets[guild.id] = (key, channel.id if channel else None, role.id if role else None, time.monotonic())
+        return channel, role
+
+    @staticmethod
+    def _find_channel(guild, welcome_channel_id):
+        channel = None
+        if welcome_channel_id:
+            channel = guild.get_channel(welcome_channel_id)
+            if not channel or not channel.permissions_for(guild.me).send_messages:
+                print(f"❌ Cannot send message in configured welcome channel ({welcome_channel_id}) for '{guild.name}'!")
+                channel = None  # Reset if the bot can't send messages there
+
+        # Only fallback if necessary
+        if not channel:
+            channel = next((c for c in guild.text_channels if c.permissions_for(guild.me).send_messages), None)
+            if not channel:
+                print(f"❌ No available channels to send a welcome message in '{guild.name}'!")
+        return channel
+
+    @staticmethod
+    def _find_role(guild, auto_role_name):
+        if not auto_role_name:
+            return None
+
+        role = discord.utils.get(guild.roles, name=auto_role_name)
+        if not role:
+            print(f"❌ Auto Role '{auto_role_name}' not found in '{guild.name}'!")
+            return None
+        if not guild.me.guild_permissions.manage_roles or role.position >= guild.me.top_role.position:
+            print(f"❌ Cannot assign '{role.name}' - Role is higher than the bot's role or lacks permission!")
+            return None
+        return role
+
+
+class WelcomeBatcher:
+    """Sends one welcome message per guild for everyone who joined within `window` seconds."""
+
+    def __init__(self, targets, window=2.0, max_mentions=20):
+        self.targets = targets
+        self.window = window
+        # Keeps a single message well under Discord's 2000 character limit
+        self.max_mentions = max_mentions
+        # guild_id -> [channel, template, members]
+        self._pending = {}
+        # Running flushes, referenced so they can't be garbage collected mid-flight
+        self._tasks = set()
+        self.members = 0
+        self.messages = 0
+
+    def add(self, member, channel, template):
+        entry = self._pending.get(member.guild.id)
+        if entry is None:
+            entry = self._pending[member.guild.id] = [channel, template, []]
+            asyncio.get_running_loop().call_later(self.window, self._start_flush, member.guild.id)
+        entry[2].append(member)
+        self.members += 1
+
+    def _start_flush(self, guild_id):
+        task = asyncio.ensure_future(self._flush(guild_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, guild_id):
+        channel, template, members = self._pending.pop(guild_id)
+        for start in range(0, len(members), self.max_mentions):
+            group = members[start:start + self.max_mentions]
+            message = template.replace("{user.mention}", ", ".join(m.mention for m in group))
+            message = message.replace("{user.name}", ", ".join(m.name for m in group))
+            try:
+                await channel.send(message)
+            except discord.DiscordException as e:
+                # The channel may be gone or closed to the bot now, resolve it again next time
+                self.targets.invalidate(guild_id)
+                print(f"❌ Error sending welcome message in '{channel.guild.name}': {str(e)}")
+                return
+            self.messages += 1
+            print(f"✅ Welcomed {len(group)} member(s) in {channel.name} ({channel.guild.name})")
+
+
+class AutoRoleQueue:
+    """
+    Assigns auto roles from a bounded queue, paced by a token bucket.
+
+    When the queue is full, put() waits for room instead of piling more API calls onto Discord.
+    Transient failures (429 and 5xx) are retried with jittered backoff.
+    """
+
+    def __init__(self, rate=5.0, burst=5, max_queue=1000, max_retries=3, has_left=None):
+        self.bucket = TokenBucket(rate, burst)
+        # has_left(member) -> True if the member left after joining; defaults to checking the member cache
+        self.has_left = has_left or (lambda member: member.guild.get_member(member.id) is None)
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self._queue = None
+        self._worker = None
+
+        self.assigned = 0
+        self.skipped = 0
+        self.failed = 0
+        self.retries = 0
+        self.backpressure_waits = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+
+    def __len__(self):
+        return self._queue.qsize() if self._queue else 0
+
+    async def put(self, member, role):
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_queue)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._work())
+
+        if self._queue.full():
+            self.backpressure_waits += 1
+        await self._queue.put((member, role, time.monotonic()))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    async def _work(self):
+        while True:
+            member, role, queued_at = await self._queue.get()
+            try:
+                await self._assign(member, role)
+            finally:
+                self.total_wait += time.monotonic() - queued_at
+                self._queue.task_done()
+
+    async def _assign(self, member, role):
+        # Left again (raid accounts often do) or already has it
+        if self.has_left(member) or role in member.roles:
+            self.skipped += 1
+            return
+
+        attempt = 0
+        while True:
+            wait = self.bucket.time_until()
+            if wait:
+                await asyncio.sleep(wait)
+            self.bucket.take()
+
+            try:
+                await member.add_roles(role, reason="Auto Role")
+            except discord.HTTPException as e:
+                if attempt < self.max_retries and (e.status == 429 or e.status >= 500):
+                    attempt += 1
+                    self.retries += 1
+                    await asyncio.sleep(random.uniform(0, 2 ** attempt))
+                    continue
+                self.failed += 1
+                print(f"❌ Error assigning Auto Role '{role.name}' to {member.name}: {str(e)}")
+                return
+
+            self.assigned += 1
+            print(f"✅ Assigned Auto Role '{role.name}' to {member.name}")
+            return
+
+    def stats(self):
+        done = self.assigned + self.skipped + self.failed
+        return {
+            "queued": len(self),
+            "max_depth": self.max_depth,
+            "assigned": self.assigned,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "retries": self.retries,
+            "backpressure_waits": self.backpressure_waits,
+            "avg_wait": self.total_wait / done if done else 0.0,
+        }
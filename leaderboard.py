@@ -0,0 +1,108 @@
+"""
+Leaderboards that are kept sorted as scores change, so reading the top N doesn't sort anything.
+"""
+import asyncio
+import time
+from bisect import bisect_left, insort
+
+
+class Leaderboard:
+    """Scores kept in ascending order; any comparable score works (ints, (level, xp) tuples, ...)."""
+
+    def __init__(self, scores=None):
+        self._scores = dict(scores or {})
+        self._ranked = sorted((score, member_id) for member_id, score in self._scores.items())
+
+    def __len__(self):
+        return len(self._scores)
+
+    def update(self, member_id, score):
+        old = self._scores.get(member_id)
+        if old == score:
+            return
+        if old is not None:
+            del self._ranked[bisect_left(self._ranked, (old, member_id))]
+        self._scores[member_id] = score
+        insort(self._ranked, (score, member_id))
+
+    def remove(self, member_id):
+        old = self._scores.pop(member_id, None)
+        if old is not None:
+            del self._ranked[bisect_left(self._ranked, (old, member_id))]
+
+    def top(self, n=10, include=None):
+        """Returns up to n (member_id, score) pairs, highest first. `include` can filter members out."""
+        result = []
+        for score, member_id in reversed(self._ranked):
+            if include is None or include(member_id):
+                result.append((member_id, score))
+                if len(result) == n:
+                    break
+        return result
+
+
+class GuildLeaderboards:
+    """One Leaderboard per guild, loaded from storage the first time the guild's board is read."""
+
+    def __init__(self, load_scores):
+        # load_scores(guild_id) -> {member_id: score}
+        self._load_scores = load_scores
+        self._boards = {}
+
+    def get(self, guild_id):
+        guild_id = str(guild_id)
+        board = self._boards.get(guild_id)
+        if board is None:
+            board = self._boards[guild_id] = Leaderboard(self._load_scores(guild_id))
+        return board
+
+    def update(self, guild_id, member_id, score):
+        # Boards that haven't been loaded yet will pick the new score up when they are
+        board = self._boards.get(str(guild_id))
+        if board is not None:
+            board.update(str(member_id), score)
+
+
+class UserNameCache:
+    """
+    Resolves user ids to display names: guild member cache first, then the bot's user cache,
+    then names fetched earlier (kept for `ttl` seconds), and only then the API, all misses at once.
+    """
+
+    def __init__(self, ttl=3600, members=None):
+        self.ttl = ttl
+        # A MemberCache, to also find recently active members discord.py doesn't keep
+        self.members = members
+        self._names = {}
+        self.fetches = 0
+
+    async def resolve(self, bot, guild, user_ids):
+        now = time.monotonic()
+        names = {}
+        missing = []
+        for user_id in user_ids:
+            member = None
+            if guild:
+                member = self.members.get(guild, int(user_id)) if self.members else guild.get_member(int(user_id))
+            user = member or bot.get_user(int(user_id))
+            if user is not None:
+                names[user_id] = user.name
+                continue
+            cached = self._names.get(user_id)
+            if cached and now - cached[1] < self.ttl:
+                names[user_id] = cached[0]
+            else:
+                missing.append(user_id)
+
+        if missing:
+            self.fetches += len(missing)
+            users = await asyncio.gather(*(bot.fetch_user(int(user_id)) for user_id in missing),
+                                         return_exceptions=True)
+            for user_id, user in zip(missing, users):
+                if isinstance(user, Exception):
+                    names[user_id] = f"Unknown user ({user_id})"
+                    continue
+                names[user_id] = user.name
+                self._names[user_id] = (user.name, now)
+
+        return names
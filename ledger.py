@@ -0,0 +1,200 @@
+"""
+Currency ledger for balances, gifts and dailies.
+
+Every change to a balance goes through Ledger, which serializes changes per guild with an
+asyncio lock and applies them through the storage backend's update_accounts(), so a transfer
+debits and credits both accounts in one step. Each change is also appended to a transaction
+log, and rebuild_balances() can recompute every account from it.
+
+Usage:
+    python ledger.py rebuild      Recompute balances from the transaction log and save them
+    python ledger.py bench [n]    Time n transfers against a throwaway database of each backend
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from storage import JsonBackend, SqliteBackend, get_storage, run_write
+
+
+def _record(guild_id, user_id, delta, kind, counterparty=None, last_flight=None, now=None):
+    record = {"time": now or time.time(), "guild_id": str(guild_id), "user_id": str(user_id),
+              "delta": delta, "kind": kind}
+    if counterparty is not None:
+        record["counterparty"] = str(counterparty)
+    if last_flight is not None:
+        record["last_flight"] = last_flight
+    return record
+
+
+def rebuild_balances(records):
+    """Replays transaction records into {guild_id: {user_id: {"miles", "last_flight"}}}."""
+    accounts = {}
+    for record in records:
+        account = accounts.setdefault(record["guild_id"], {}).setdefault(
+            record["user_id"], {"miles": 0, "last_flight": 0.0})
+        account["miles"] += record["delta"]
+        if record.get("last_flight") is not None:
+            account["last_flight"] = max(account["last_flight"], record["last_flight"])
+    return accounts
+
+
+class Ledger:
+    def __init__(self, storage):
+        self.storage = storage
+        self._locks = defaultdict(asyncio.Lock)
+        # called as listener(guild_id, {user_id: account}) after every applied change
+        self.listeners = []
+
+    def open(self):
+        """Logs the current balances as opening entries the first time the ledger is used."""
+        def opening_records():
+            now = time.time()
+            return [
+                _record(guild_id, user_id, account["miles"], "opening", last_flight=account["last_flight"], now=now)
+                for guild_id, accounts in self.storage.load_currency().items()
+                for user_id, account in accounts.items()
+            ]
+
+        self.storage.start_transaction_log(opening_records)
+
+    async def _apply(self, guild_id, user_ids, change):
+        changed = {}
+
+        def apply(accounts):
+            records = change(accounts)
+            if records is not None:
+                changed.update(accounts)
+            return records
+
+        async with self._locks[str(guild_id)]:
+            if not await run_write(self.storage, self.storage.update_accounts, guild_id, user_ids, apply):
+                return False
+
+        for listener in self.listeners:
+            listener(str(guild_id), changed)
+        return True
+
+    async def balance(self, guild_id, user_id):
+        # A single-row read; WAL readers don't wait for writers
+        account = self.storage.get_account(guild_id, user_id)  # blocking: ok
+        return account["miles"] if account else 0
+
+    async def deposit(self, guild_id, user_id, amount, kind="deposit"):
+        def change(accounts):
+            accounts[str(user_id)]["miles"] += amount
+            return [_record(guild_id, user_id, amount, kind)]
+
+        return await self._apply(guild_id, [user_id], change)
+
+    async def withdraw(self, guild_id, user_id, amount, kind="withdraw"):
+        """Removes money if the user has enough. Returns whether it did."""
+        def change(accounts):
+            account = accounts[str(user_id)]
+            if account["miles"] < amount:
+                return None
+            account["miles"] -= amount
+            return [_record(guild_id, user_id, -amount, kind)]
+
+        return await self._apply(guild_id, [user_id], change)
+
+    async def transfer(self, guild_id, sender_id, recipient_id, amount):
+        """Moves money between two users atomically. Returns False if the sender can't afford it."""
+        if amount <= 0 or str(sender_id) == str(recipient_id):
+            return False
+
+        def change(accounts):
+            sender, recipient = accounts[str(sender_id)], accounts[str(recipient_id)]
+            if sender["miles"] < amount:
+                return None
+            sender["miles"] -= amount
+            recipient["miles"] += amount
+            return [
+                _record(guild_id, sender_id, -amount, "transfer", counterparty=recipient_id),
+                _record(guild_id, recipient_id, amount, "transfer", counterparty=sender_id),
+            ]
+
+        return await self._apply(guild_id, [sender_id, recipient_id], change)
+
+    async def claim_daily(self, guild_id, user_id, amount, cooldown):
+        """Pays out a daily reward if `cooldown` seconds have passed. Returns (claimed, seconds_left)."""
+        seconds_left = 0
+
+        def change(accounts):
+            nonlocal seconds_left
+            account = accounts[str(user_id)]
+            now = time.time()
+            if now - account["last_flight"] < cooldown:
+                seconds_left = cooldown - (now - account["last_flight"])
+                return None
+            account["miles"] += amount
+            account["last_flight"] = now
+            return [_record(guild_id, user_id, amount, "daily", last_flight=now, now=now)]
+
+        claimed = await self._apply(guild_id, [user_id], change)
+        return claimed, seconds_left
+
+
+def rebuild(storage):
+    """Recomputes every balance from the transaction log and saves it. Returns the number of accounts that changed."""
+    rebuilt = rebuild_balances(storage.load_transactions())
+    current = storage.load_currency()
+    changed = [
+        (guild_id, user_id, account)
+        for guild_id, accounts in rebuilt.items()
+        for user_id, account in accounts.items()
+        if current.get(guild_id, {}).get(user_id) != account
+    ]
+    if changed:
+        storage.put_accounts(changed)
+    return len(changed)
+
+
+async def _bench(backend, transfers):
+    ledger = Ledger(backend)
+    guild_id, users = "1", [str(user_id) for user_id in range(100)]
+    for user_id in users:
+        await ledger.deposit(guild_id, user_id, 1_000_000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        ledger.transfer(guild_id, users[i % len(users)], users[(i * 7 + 1) % len(users)], 1)
+        for i in range(transfers)
+    ))
+    elapsed = time.perf_counter() - start
+
+    total = sum(account["miles"] for account in backend.load_currency()[guild_id].values())
+    assert total == len(users) * 1_000_000, "money was created or destroyed"
+    assert rebuild_balances(backend.load_transactions()) == backend.load_currency(), "log does not match balances"
+    return transfers / elapsed
+
+
+def bench(transfers):
+    home = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for label, make_backend in (("json", lambda: JsonBackend(fsync=False)),
+                                        ("sqlite", lambda: SqliteBackend(os.path.join(directory, "bench.db")))):
+                backend = make_backend()
+                rate = asyncio.run(_bench(backend, transfers))
+                backend.close()
+                print(f"{label}: {rate:,.0f} transfers/second")
+        finally:
+            os.chdir(home)
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "rebuild":
+        storage = get_storage()
+        print(f"✅ Rebuilt balances from the transaction log, {rebuild(storage)} accounts changed.")
+        storage.close()
+    elif command == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
+    else:
+        print("Usage: python ledger.py rebuild | python ledger.py bench [transfers]")
+        sys.exit(1)
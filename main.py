@@ -1,49 +1,229 @@
+import time
+startup_began = time.perf_counter()  # taken before the imports below, for the startup report
+
 import discord
 import os
-from discord.ext import commands
-import requests
+from discord.ext import commands, tasks
+import aiohttp
 import random
 import asyncio
 import json
-import time
-from openai import OpenAI
+import logging
+import typing
 from eight_ball_answers import eight_ball_answers
-
-# Files for storage
-CACHE_FILE = "ai_cache.json"
-POSTCARD_FILE = "postcards.json"
+from storage import get_storage, run_write
+from ledger import Ledger
+from leaderboard import GuildLeaderboards, UserNameCache
+from reaction_roles import ReactionRoleIndex, RoleChangeBatcher
+from pipeline import MessagePipeline
+from custom_commands import CustomCommandIndex, normalize_command
+from joins import JoinTargets, WelcomeBatcher, AutoRoleQueue
+from flows import Flow
+from postcards import Mailboxes, PostcardPages, DeliveryQueue, FORBIDDEN
+from metrics import Registry
+from startup import StartupTimer
+from http_client import get_session, close_session
+from ai_cache import AICache, make_key, prompt_scope
+from ai_client import AIClientManager, SingleFlight, AIScheduler, AIQueueFull
+from streaming import StreamingReply, split_message
+from result_cache import ResultPool
+from prefetch import PrefetchBuffer
+from member_cache import MemberCache, cache_options
+from xp import XPTracker
+
+startup = StartupTimer(startup_began)
+startup.mark("imports")
+
+log = logging.getLogger("milo")
+
+# Latency histograms and counters for commands, events, upstream APIs and storage
+metrics = Registry()
+
+# Where the Prometheus-style /metrics endpoint listens (port 0 turns it off)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Sharding: SHARD_COUNT and SHARD_IDS (e.g. "0,1,2", set by cluster.py for each process) run the bot
+# as an AutoShardedBot with those shards; AUTO_SHARD=1 lets Discord pick the number of shards
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip()] or None
+SHARDED = bool(SHARD_COUNT or SHARD_IDS or os.getenv("AUTO_SHARD") == "1")
+CLUSTER_ID = int(os.getenv("CLUSTER_ID", "0"))
+
+# Set when several bot processes use the same storage (cluster.py does)
+SHARED_STORAGE = os.getenv("SHARED_STORAGE") == "1"
+
+# How often (in seconds) each process reports the health of its shards
+SHARD_HEALTH_INTERVAL = 30
+
+# Persistent data lives behind a storage backend (JSON files or SQLite, see storage.py)
+storage = get_storage()
+if SHARED_STORAGE and storage.name != "sqlite":
+    raise SystemExit("❌ Several processes can only share the SQLite backend, set STORAGE_BACKEND=sqlite.")
+metrics.instrument_storage(storage)
+
+# How often (in seconds) and after how many updates XP is flushed to disk
+XP_FLUSH_INTERVAL = 30
+XP_FLUSH_THRESHOLD = 50
+
+# Minimum time (in seconds) between XP awards for the same user
+XP_COOLDOWN = 60
+
+# AI response cache limits and how often (in seconds) new entries are written to storage
+AI_CACHE_MAX_ENTRIES = 5000
+AI_CACHE_MAX_BYTES = 5_000_000
+AI_CACHE_TTL = 7 * 24 * 3600
+AI_CACHE_FLUSH_INTERVAL = 60
+
+# Client-side AI rate limits (requests per second and burst size), queue size and retries
+AI_GLOBAL_RATE = 1.0
+AI_GLOBAL_BURST = 5
+AI_GUILD_RATE = 0.2
+AI_GUILD_BURST = 3
+AI_QUEUE_SIZE = 50
+AI_MAX_RETRIES = 3
+
+# AI API connection settings (pool size, keep-alive and request timeout in seconds)
+AI_BASE_URL = "https://api.aimlapi.com/v1"
+AI_MODEL = "google/gemma-2b-it"
+AI_POOL_SIZE = 20
+AI_KEEPALIVE_TIMEOUT = 60
+AI_TIMEOUT = 60
+
+# Stream AI responses into a message that is edited at most once per interval (seconds)
+AI_STREAMING = True
+AI_STREAM_EDIT_INTERVAL = 1.0
+
+# Postcards waiting per mailbox, how long (seconds) they are kept, and how many are shown per page
+POSTCARD_MAILBOX_LIMIT = 50
+POSTCARD_MAX_AGE = 30 * 24 * 3600
+POSTCARD_PAGE_SIZE = 5
+POSTCARD_EXPIRY_INTERVAL = 3600
+
+# "You've got mail" DMs sent at the same time, and DMs per second (and burst)
+POSTCARD_DM_CONCURRENCY = 5
+POSTCARD_DM_RATE = 5.0
+POSTCARD_DM_BURST = 5
+
+# ;gif and ;image results kept per search: how many searches, how long (seconds) they are kept,
+# and after how long they are refreshed in the background
+RESULT_POOL_MAX_QUERIES = 500
+RESULT_POOL_TTL = 24 * 3600
+RESULT_POOL_REFRESH_AFTER = 3600
+
+# Cat image URLs kept ready: refilled below the low watermark, up to the high one, in batches
+CAT_BUFFER_LOW = 5
+CAT_BUFFER_HIGH = 30
+CAT_BATCH_SIZE = 10
+
+# Joins within this window (seconds) share one welcome message
+WELCOME_BATCH_WINDOW = 2.0
+WELCOME_BATCH_MAX_MENTIONS = 20
+
+# Auto role assignments per second (and burst), and how many may wait in the queue
+AUTO_ROLE_RATE = 5.0
+AUTO_ROLE_BURST = 5
+AUTO_ROLE_QUEUE_SIZE = 1000
+DEFAULT_AI_PROMPT = "You are named Milo cannot write more than 2000 carachters You are a discord bot to help boost engagement."
+
+# Which members are kept in memory: full, lazy or lean (see member_cache.py), and how many
+# recently active members the lean profile keeps
+MEMBER_CACHE = os.getenv("MEMBER_CACHE", "lean")
+MEMBER_CACHE_MAX = 5000
+
+# How far down the global XP board ;levelboard looks for members of the server
+LEVELBOARD_MAX_CANDIDATES = 1000
 
 # Set intents
 intents = discord.Intents.default()
 intents.messages = True
 intents.message_content = True
 intents.members = True
+member_cache_flags, chunk_guilds_at_startup = cache_options(MEMBER_CACHE, intents)
 
 
 # Initialize bot
-bot = commands.Bot(command_prefix=';', intents=intents)
+if SHARDED:
+    bot = commands.AutoShardedBot(command_prefix=';', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+                                  member_cache_flags=member_cache_flags, chunk_guilds_at_startup=chunk_guilds_at_startup)
+else:
+    bot = commands.Bot(command_prefix=';', intents=intents,
+                       member_cache_flags=member_cache_flags, chunk_guilds_at_startup=chunk_guilds_at_startup)
+
+# Recently active members, and member lookups batched into gateway requests
+member_cache = MemberCache(MEMBER_CACHE_MAX)
+
+# How often (in seconds) stored settings are checked for changes made outside the bot
+SETTINGS_RELOAD_INTERVAL = 10
+
+# Parsed settings for every guild, shared by the whole process
+settings_cache = {}
+settings_version = None
+
+# (guild, message, emoji) -> role lookups built from the settings, and batched role updates
+reaction_roles = ReactionRoleIndex()
+role_changes = RoleChangeBatcher()
+
+# Compiled custom command tables per guild, rebuilt when commands change
+custom_commands = CustomCommandIndex()
+
+# Welcome channel and auto role per guild, batched welcomes and the auto role queue
+join_targets = JoinTargets()
+welcomes = WelcomeBatcher(join_targets, WELCOME_BATCH_WINDOW, WELCOME_BATCH_MAX_MENTIONS)
+auto_roles = AutoRoleQueue(AUTO_ROLE_RATE, AUTO_ROLE_BURST, AUTO_ROLE_QUEUE_SIZE,
+                           has_left=lambda member: member_cache.has_left(member.guild.id, member.id))
+
+
+def refresh_settings():
+    """Reloads stored settings into the settings cache, but only if they changed since the last load."""
+    global settings_version
+    version = storage.settings_version()
+    if version == settings_version:
+        return
+
+    try:
+        data = storage.load_settings()
+    except json.JSONDecodeError:
+        # Keep serving the last good copy rather than wiping every guild's settings
+        print("❌ Stored settings are malformed, keeping the cached settings.")
+        return
+
+    settings_cache.clear()
+    settings_cache.update(data)
+    settings_version = version
+    reaction_roles.rebuild(settings_cache)
+    custom_commands.rebuild(settings_cache)
 
-SETTINGS_FILE = "Settings.json"
 
 def load_settings():
-    """Loads settings from Settings.json or returns an empty dictionary if the file doesn't exist."""
-    if not os.path.exists(SETTINGS_FILE):
-        return {}
+    """Returns the cached settings for all guilds. Callers may modify it and persist a guild with save_guild_settings()."""
+    return settings_cache
+
+
+def get_guild_settings(guild_id):
+    """Returns the cached settings for a single guild, or an empty dictionary if none are set."""
+    return settings_cache.get(str(guild_id), {})
+
+
+def save_guild_settings(guild_id):
+    """Persists one guild's entry from the settings cache."""
+    guild_id = str(guild_id)
+    storage.put_guild_settings(guild_id, settings_cache.get(guild_id, {}))
+
+
+def remember_settings_write(version):
+    # Our own write (once it is on disk) is already in the cache, so the reload task doesn't load it again
+    global settings_version
+    settings_version = version
 
-    with open(SETTINGS_FILE, "r", encoding="utf-8") as file:
-        try:
-            return json.load(file)
-        except json.JSONDecodeError:
-            return {}  # Return an empty dictionary if the JSON is malformed
 
-def save_settings(settings):
-    """Saves the given settings dictionary to Settings.json."""
-    with open(SETTINGS_FILE, "w", encoding="utf-8") as file:
-        json.dump(settings, file, indent=4)
+storage.settings_listeners.append(remember_settings_write)
+
 
 def update_setting(guild_id: str, setting_key: str, setting_value):
     """Updates a specific setting for a guild while preserving existing settings."""
     settings = load_settings()
+    guild_id = str(guild_id)
 
     # Ensure the guild has an entry
     if guild_id not in settings:
@@ -53,131 +233,184 @@ def update_setting(guild_id: str, setting_key: str, setting_value):
     settings[guild_id][setting_key] = setting_value
 
     # Save the updated settings
-    save_settings(settings)
+    save_guild_settings(guild_id)
 
 
+@tasks.loop(seconds=SETTINGS_RELOAD_INTERVAL)
+async def settings_reload_task():
+    """Picks up settings changed outside the bot without touching storage on every event."""
+    refresh_settings()
 
-def load_currency():
-    try:
-        with open("currency.json", "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
 
+refresh_settings()
 
-# Save currency data
-def save_currency(data):
-    with open("currency.json", "w") as f:
-        json.dump(data, f, indent=4)
 
+# All balance changes go through the ledger (per-guild locking, atomic transfers, transaction log)
+ledger = Ledger(storage)
+ledger.open()
 
-# Get user balance (per server)
-def get_balance(guild_id, user_id):
-    data = load_currency()
-    return data.get(str(guild_id), {}).get(str(user_id), 0)
+# Per-guild gem leaderboards, kept sorted as the ledger changes balances
+gem_boards = GuildLeaderboards(
+    lambda guild_id: {user_id: account["miles"] for user_id, account in storage.load_guild_accounts(guild_id).items()})
 
 
-# Add money to a user (per server)
-def add_money(guild_id, user_id, amount):
-    data = load_currency()
-    guild_id = str(guild_id)
-    user_id = str(user_id)
+def update_gem_boards(guild_id, accounts):
+    for user_id, account in accounts.items():
+        gem_boards.update(guild_id, user_id, account["miles"])
 
-    if guild_id not in data:
-        data[guild_id] = {}
-    if user_id not in data[guild_id]:
-        data[guild_id][user_id] = 0
 
-    data[guild_id][user_id] += amount
-    save_currency(data)
+ledger.listeners.append(update_gem_boards)
 
+# Names shown on leaderboards for users who aren't in the member cache
+user_names = UserNameCache(members=member_cache)
 
-# Remove money from a user (per server)
-def remove_money(guild_id, user_id, amount):
-    data = load_currency()
-    guild_id = str(guild_id)
-    user_id = str(user_id)
 
-    if guild_id not in data or user_id not in data[guild_id] or data[guild_id][
-            user_id] < amount:
-        return False  # Not enough money
+def load_cache():
+    """Load the AI response cache from storage"""
+    cache = AICache(AI_CACHE_MAX_ENTRIES, AI_CACHE_MAX_BYTES, AI_CACHE_TTL)
+    cache.load(storage.load_ai_cache())
+    return cache
 
-    data[guild_id][user_id] -= amount
-    save_currency(data)
-    return True
 
+def get_response_cache():
+    """Returns the AI response cache, loading it from storage the first time it's needed"""
+    global response_cache
+    if response_cache is None:
+        with startup.loading("ai cache"):
+            response_cache = load_cache()
+    return response_cache
 
-def load_cache():
-    """Load AI response cache from a JSON file"""
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r") as file:
-            return json.load(file)
-    return {}
 
+def flush_cache():
+    """Write new and removed AI cache entries to storage"""
+    # Nothing can have changed if the cache was never loaded
+    if response_cache is None:
+        return
+    rows, deleted = response_cache.take_pending()
+    if rows:
+        storage.put_ai_responses(rows)
+    if deleted:
+        storage.delete_ai_responses(deleted)
 
-def save_cache(cache):
-    """Save AI response cache to a JSON file"""
-    with open(CACHE_FILE, "w") as file:
-        json.dump(cache, file)
 
+def ai_cache_key(guild, user_input):
+    """Responses made with a guild's custom AI Prompt are only reused inside that guild, with that prompt"""
+    if guild and "AI Prompt" in get_guild_settings(guild.id):
+        return make_key(user_input, prompt_scope(guild.id, get_guild_settings(guild.id)["AI Prompt"]))
+    return make_key(user_input)
 
-def load_postcards():
-    """Load postcards data from a JSON file"""
-    if os.path.exists(POSTCARD_FILE):
-        with open(POSTCARD_FILE, "r") as file:
-            return json.load(file)
-    return {}
 
+# One long-lived, pooled client per AI API
+ai_clients = AIClientManager(AI_POOL_SIZE, AI_KEEPALIVE_TIMEOUT, AI_TIMEOUT)
 
-def save_postcards(postcards):
-    """Save postcards data to a JSON file"""
-    with open(POSTCARD_FILE, "w") as file:
-        json.dump(postcards, file)
+# Concurrent ;ai requests with the same cache key share one upstream call
+ai_requests = SingleFlight()
 
+# Paces upstream AI calls per guild and globally, queueing the rest
+ai_scheduler = AIScheduler(AI_GLOBAL_RATE, AI_GLOBAL_BURST, AI_GUILD_RATE, AI_GUILD_BURST,
+                           AI_QUEUE_SIZE, AI_MAX_RETRIES)
 
-def read_user_data():
-    try:
-        with open('user_data.json', 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
 
+async def fetch_ai_response(cache_key, user_input, guild_id, on_queued=None, on_text=None):
+    """
+    Asks the AI for a response and caches it. Only one call per cache key runs at a time.
+    If the call has to wait for the rate limiter, on_queued(position) is awaited first.
+    If on_text is given, the response is streamed and on_text(text_so_far) is awaited as it grows.
+    """
+    async def fetch():
+        future, position = ai_scheduler.submit(guild_id, lambda: get_ai(user_input, guild_id, on_text))
+        if position and on_queued:
+            await on_queued(position)
+        response = await future
+        # An empty answer isn't worth repeating for a week
+        if response and response.strip():
+            get_response_cache().put(cache_key, response)
+        return response
+
+    return await ai_requests.do(cache_key, fetch)
+
+
+# XP is kept in memory (loaded by load_user_xp() on first use) and written back in batches
+# instead of on every message, see xp.py
+xp_tracker = XPTracker(storage, XP_FLUSH_THRESHOLD)
+
+# user_id -> when they were last awarded XP (time.monotonic()), pruned by flush_xp_task
+xp_last_awarded = {}
 
-# Function to save user data to the JSON file
-def save_user_data(data):
-    with open('user_data.json', 'w') as f:
-        json.dump(data, f, indent=4)
 
+def load_user_xp():
+    """Loads XP and builds the XP leaderboard the first time either is needed."""
+    if xp_tracker.user_xp is None:
+        with startup.loading("xp"):
+            xp_tracker.load()
+    return xp_tracker.user_xp
 
-# Function to update XP and level for a user
-def update_xp(user_id, xp_earned):
-    data = read_user_data()
 
-    if user_id not in data:
-        data[user_id] = {"xp": 0, "level": 1}
+@tasks.loop(seconds=XP_FLUSH_INTERVAL)
+async def flush_xp_task():
+    """Periodically writes pending XP changes to disk."""
+    await xp_tracker.flush_async()
 
-    data[user_id]["xp"] += xp_earned
+    # Awards older than the cooldown no longer hold anyone back, so forget them
+    now = time.monotonic()
+    for user_id in [user_id for user_id, awarded in xp_last_awarded.items() if now - awarded >= XP_COOLDOWN]:
+        del xp_last_awarded[user_id]
 
-    # Check if the user leveled up
-    xp_to_next_level = data[user_id][
-        "level"] * 100  # Level up at 100 XP per level
-    if data[user_id]["xp"] >= xp_to_next_level:
-        data[user_id]["level"] += 1
-        data[user_id]["xp"] = 0  # Reset XP after leveling up
 
-    save_user_data(data)
+@tasks.loop(seconds=AI_CACHE_FLUSH_INTERVAL)
+async def flush_cache_task():
+    """Periodically writes AI cache changes to storage."""
+    flush_cache()
 
 
-# Load the cache when the bot starts
-response_cache = load_cache()
+# Loaded by get_response_cache() on the first ;ai, not when the bot starts
+response_cache = None
 
-# Load postcard storage from JSON
-postcard_storage = load_postcards()
+# Postcards waiting to be opened, stored one record per postcard
+mailboxes = Mailboxes(storage, POSTCARD_MAILBOX_LIMIT, POSTCARD_MAX_AGE, shared=SHARED_STORAGE)
+postcard_dms = DeliveryQueue(POSTCARD_DM_CONCURRENCY, POSTCARD_DM_RATE, POSTCARD_DM_BURST)
 
+# List of random postcard messages if no custom message is provided
+RANDOM_POSTCARDS = [
+    "Greetings from Paris! 🗼✨ Hope you enjoy the Eiffel Tower and the local croissants!",
+    "A sunny day in Bali! 🌴🌊 Don't forget to visit the temples and beaches!",
+    "Exploring Tokyo! 🏙️🍣 Amazing food and an awesome blend of tradition and technology!",
+    "Cheers from London! 🎡🌧️ Be sure to visit the Tower of London and Big Ben!",
+    "Wanderlust in New York City! 🗽🌆 Enjoy the skyline and the amazing parks!"
+]
 
-def get_random_gif(search_term: str, apikey: str, ckey: str, limit: int = 8):
+
+def make_postcard(author, message=None):
+    """Returns the postcard text: the message (or a random one) signed by the author."""
+    # If no message is provided, choose a random postcard
+    if not message:
+        message = random.choice(RANDOM_POSTCARDS)
+
+    # Append the "from" message at the end of the postcard
+    return message + f"\n\nFrom: {author.name} ({author.mention})"
+
+
+def postcard_notification(author):
+    return f"📬 You've received a new postcard from {author.name} ({author.mention})! Use `;openpostcard` to view your postcards. 🎉"
+
+
+@tasks.loop(seconds=POSTCARD_EXPIRY_INTERVAL)
+async def expire_postcards_task():
+    """Periodically throws away postcards nobody opened in time."""
+    removed = mailboxes.expire()
+    if removed:
+        print(f"✅ Expired {removed} unopened postcards")
+
+
+# Full result pages from Tenor and Pixabay per search, so repeated searches don't call them again
+gif_pool = ResultPool(RESULT_POOL_MAX_QUERIES, RESULT_POOL_TTL, RESULT_POOL_REFRESH_AFTER)
+image_pool = ResultPool(RESULT_POOL_MAX_QUERIES, RESULT_POOL_TTL, RESULT_POOL_REFRESH_AFTER)
+
+
+async def get_random_gif(search_term: str, apikey: str, ckey: str, limit: int = 8):
     """
     Returns a random GIF URL based on a search term using the Tenor API.
+    Results are pooled per search term, so repeated searches pick from the pool without calling Tenor.
 
     Args:
         search_term (str): The search term to find GIFs (e.g., "excited").
@@ -186,55 +419,49 @@ def get_random_gif(search_term: str, apikey: str, ckey: str, limit: int = 8):
         limit (int): The number of results to fetch (default is 8).
 
     Returns:
-        str: URL of a random GIF or None if the request failed.
+        str: URL of a random GIF, or a message saying why there isn't one.
     """
+    gif_url = await gif_pool.pick(search_term, lambda query: fetch_gif_urls(query, apikey, ckey, limit))
+    return gif_url or "No GIFs found or error occurred."
+
+
+async def fetch_gif_urls(search_term, apikey, ckey, limit):
+    """Returns the URLs of every usable GIF Tenor found, or None if the request failed."""
+    params = {'q': search_term, 'key': apikey, 'client_key': ckey, 'limit': limit}
+
     # Make the request to the Tenor API
-    r = requests.get(
-        f"https://tenor.googleapis.com/v2/search?q={search_term}&key={apikey}&client_key={ckey}&limit={limit}"
-    )
+    try:
+        async with metrics.upstream("tenor") as call, \
+                get_session().get("https://tenor.googleapis.com/v2/search", params=params) as r:
+            call.status = r.status
+            if r.status != 200:
+                return None
+            # Load the GIFs using the urls for the smaller GIF sizes
+            top_gifs = await r.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error fetching GIF: {e}")
+        return None
 
-    if r.status_code == 200:
-        # Load the GIFs using the urls for the smaller GIF sizes
-        top_gifs = json.loads(r.content)
-
-        # Debugging: Print out the top_gifs to inspect the structure
-        print(json.dumps(
-            top_gifs,
-            indent=4))  # This will print the response in a readable format
-
-        # Check if there are results and the 'media_formats' key is in each result
-        if 'results' in top_gifs:
-            gifs = top_gifs['results']
-
-            # Filter out results that don't have 'media_formats' or 'gif' format
-            valid_gifs = [
-                gif for gif in gifs
-                if 'media_formats' in gif and 'gif' in gif['media_formats']
-            ]
-
-            if valid_gifs:
-                # Randomly select a valid GIF and return its GIF URL
-                random_gif = random.choice(valid_gifs)
-                gif_url = random_gif['media_formats']['gif']['url']
-
-                # Ensure the URL is not too long
-                if len(gif_url
-                       ) <= 2000:  # Discord allows up to 2000 characters
-                    return gif_url
-                else:
-                    return "Error: The GIF URL is too long."
-    return "No GIFs found or error occurred."
+    # Debugging: log the whole response to inspect the structure (run with LOG_LEVEL=DEBUG)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Tenor response: %s", json.dumps(top_gifs, indent=4))
+
+    # Keep results that have a 'gif' format whose URL fits in a message (Discord allows up to 2000 characters)
+    return [
+        gif['media_formats']['gif']['url']
+        for gif in top_gifs.get('results', [])
+        if 'media_formats' in gif and 'gif' in gif['media_formats']
+        and len(gif['media_formats']['gif']['url']) <= 2000
+    ]
 
 
-# Example usage:
-search_term = "excited"  # You can change this to any search term
-gif_url = get_random_gif(search_term,
-                         apikey="YOUR_API_KEY",
-                         ckey="my_test_app")
-print(gif_url)  # This will print the URL of the GIF to be sent to Discord
+async def get_pixabay_image(query):
+    """Returns a random image URL for the query, picked from the pooled Pixabay results, or None."""
+    return await image_pool.pick(query, fetch_pixabay_urls)
 
 
-def get_pixabay_image(query):
+async def fetch_pixabay_urls(query):
+    """Returns the URLs of every image Pixabay found, or None if the request failed."""
     PIXABAY_API_KEY = os.getenv('PIXABAY_API_KEY')
     PIXABAY_URL = "https://pixabay.com/api/"
     params = {
@@ -246,64 +473,79 @@ def get_pixabay_image(query):
     }
 
     try:
-        response = requests.get(PIXABAY_URL, params=params)
-        data = response.json()
-
-        # If we got results from Pixabay
-        if data['totalHits'] > 0:
-            # Randomly pick an image from the results
-            image = random.choice(data['hits'])
-            return image['webformatURL']
-        else:
-            return None
-    except requests.exceptions.RequestException as e:
+        async with metrics.upstream("pixabay") as call, get_session().get(PIXABAY_URL, params=params) as response:
+            call.status = response.status
+            if response.status != 200:
+                return None
+            data = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         print(f"Error fetching image: {e}")
         return None
 
+    return [image['webformatURL'] for image in data.get('hits', [])]
 
-def get_ai(user_input: str):
-    base_url = "https://api.aimlapi.com/v1"
-    api_key = os.getenv('AI_API_KEY')
-    system_prompt = "You are named Milo cannot write more than 2000 carachters You are a discord bot to help boost engagement."
 
-    api = OpenAI(api_key=api_key, base_url=base_url)
+async def get_ai(user_input: str, guild_id=None, on_text=None):
+    # Use the guild's custom prompt from the settings cache if one was set with ;setaiprompt
+    system_prompt = get_guild_settings(guild_id).get("AI Prompt", DEFAULT_AI_PROMPT) if guild_id else DEFAULT_AI_PROMPT
+
     MAX_MESSAGE_LENGTH = 232
 
     # Truncate user input if it's too long
     if len(user_input) > MAX_MESSAGE_LENGTH:
         user_input = user_input[:MAX_MESSAGE_LENGTH]
 
-    completion = api.chat.completions.create(
-        model="google/gemma-2b-it",
-        messages=[
-            {
-                "role": "system",
-                "content": system_prompt
-            },
-            {
-                "role": "user",
-                "content": user_input
-            },
-        ],
-        temperature=0.7,
-        max_tokens=255,
-    )
+    messages = [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": user_input
+        },
+    ]
+
+    # Reuse the pooled client for this API instead of connecting from scratch
+    api = ai_clients.get(AI_BASE_URL, os.getenv('AI_API_KEY'))
+    if on_text is None:
+        async with metrics.upstream("ai"):
+            response = await api.chat(AI_MODEL, messages, temperature=0.7, max_tokens=255)
+        return response  # Ensure this returns a string
 
-    response = completion.choices[0].message.content
-    return response  # Ensure this returns a string
+    # Streaming: report the text generated so far after every chunk
+    parts = []
+    async with metrics.upstream("ai"):
+        async for delta in api.stream_chat(AI_MODEL, messages, temperature=0.7, max_tokens=255):
+            parts.append(delta)
+            await on_text("".join(parts))
+    return "".join(parts)
 
 
-def get_cat():
+async def fetch_cats(limit):
+    """Returns up to `limit` random cat image URLs from TheCatAPI. Raises on errors."""
     url = "https://api.thecatapi.com/v1/images/search"
-    cat_api_key = os.environ['CATAPIKEY']
-    headers = {'x-api-key': cat_api_key}
+    cat_api_key = os.getenv('CATAPIKEY')
+    headers = {'x-api-key': cat_api_key} if cat_api_key else {}
+
+    async with metrics.upstream("thecatapi") as call, \
+            get_session().get(url, headers=headers, params={'limit': limit}) as response:
+        call.status = response.status
+        response.raise_for_status()
+        return [cat['url'] for cat in await response.json()]
+
+
+# Cat pictures are fetched ahead of time, so ;cat doesn't wait for TheCatAPI
+cat_buffer = PrefetchBuffer(fetch_cats, CAT_BUFFER_LOW, CAT_BUFFER_HIGH, CAT_BATCH_SIZE)
 
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()[0]['url']
+
+async def get_cat():
+    """Returns a cat image URL from the prefetch buffer, or None if there are none and TheCatAPI is down."""
+    return await cat_buffer.get()
 
 
 @bot.event
+@metrics.timed_event
 async def on_guild_join(guild):
     """Triggered when the bot joins a new guild."""
 
@@ -330,118 +572,241 @@ async def on_guild_join(guild):
     else:
         print(f"No available channels to send a welcome message in '{guild.name}'!")
 @bot.event
+@metrics.timed_event
 async def on_member_join(member):
-    """Handles new member joins, sends a welcome message in the correct channel, and assigns an auto role."""
-    settings = load_settings()
-    guild_id = str(member.guild.id)
-    guild_settings = settings.get(guild_id, {})
+    """Handles new member joins, queues a welcome message in the correct channel, and queues the auto role."""
+    member_cache.remember(member)
+    guild_settings = get_guild_settings(member.guild.id)
 
-    # Get the welcome message (with member ping and name)
-    welcome_message = guild_settings.get("Welcome message", f"Welcome {member.mention} to {member.guild.name}! 🎉")
+    # Resolved once per guild and reused until the settings, channels or roles change
+    channel, role = join_targets.resolve(member.guild, guild_settings)
 
-    # Replace placeholders with actual values
-    welcome_message = welcome_message.replace("{user.mention}", member.mention).replace("{user.name}", member.name)
+    # Get the welcome message (with member ping and name), sent together with anyone else joining right now
+    if channel:
+        welcome_message = guild_settings.get("Welcome message", f"Welcome {{user.mention}} to {member.guild.name}! 🎉")
+        welcomes.add(member, channel, welcome_message)
 
-    # Get the stored welcome channel ID
-    welcome_channel_id = guild_settings.get("Welcome Channel")
-    channel = None
+    # Auto Role Assignment
+    if role:
+        await auto_roles.put(member, role)
 
-    if welcome_channel_id:
-        channel = bot.get_channel(welcome_channel_id)  # Ensure the bot retrieves the channel properly
-        if not channel or not channel.permissions_for(member.guild.me).send_messages:
-            print(f"❌ Cannot send message in configured welcome channel ({welcome_channel_id}) for '{member.guild.name}'!")
-            channel = None  # Reset if the bot can't send messages there
 
-    # Only fallback if necessary
-    if not channel:
-        channel = next((c for c in member.guild.text_channels if c.permissions_for(member.guild.me).send_messages), None)
+@bot.event
+async def on_raw_member_remove(payload):
+    # Sent for every member who leaves, cached or not
+    member_cache.forget(payload.guild_id, payload.user.id)
 
-    if channel:
-        await channel.send(welcome_message)
-        print(f"✅ Sent welcome message in {channel.name} ({member.guild.name})")
-    else:
-        print(f"❌ No available channels to send a welcome message in '{member.guild.name}'!")
 
-    # Auto Role Assignment
-    auto_role_name = guild_settings.get("Auto Role")
-    if auto_role_name:
-        role = discord.utils.get(member.guild.roles, name=auto_role_name)
-
-        if role:
-            if member.guild.me.guild_permissions.manage_roles and role.position < member.guild.me.top_role.position:
-                await member.add_roles(role)
-                print(f"✅ Assigned Auto Role '{role.name}' to {member.name}")
-            else:
-                print(f"❌ Cannot assign '{role.name}' - Role is higher than the bot's role or lacks permission!")
-        else:
-            print(f"❌ Auto Role '{auto_role_name}' not found in '{member.guild.name}'!")
+# Forget a guild's welcome channel and auto role when its channels or roles change
+@bot.event
+async def on_guild_channel_delete(channel):
+    join_targets.invalidate(channel.guild.id)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    join_targets.invalidate(after.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    join_targets.invalidate(role.guild.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    join_targets.invalidate(after.guild.id)
 
 activity = discord.Game(name=";ai")
 @bot.event
 async def on_ready():
     print(f'Logged in as {bot.user}!')
     print(bot.commands)
+    if not flush_xp_task.is_running():
+        flush_xp_task.start()
+    if not settings_reload_task.is_running():
+        settings_reload_task.start()
+    if not flush_cache_task.is_running():
+        flush_cache_task.start()
+    if not expire_postcards_task.is_running():
+        expire_postcards_task.start()
+    if not shard_health_task.is_running():
+        shard_health_task.start()
+    cat_buffer.start()
+    start_metrics()
+    if not startup.done:
+        startup.done = True
+        startup.mark("gateway")
+        print(startup.report())
     await bot.change_presence(activity=activity)
 
+
 @bot.event
-async def on_raw_reaction_remove(payload):
-    """Handles role removal when a user removes a reaction from a message."""
-    guild_id = str(payload.guild_id)
-    member = await bot.guilds[0].fetch_member(payload.user_id)
-    settings = load_settings()
+async def on_connect():
+    # Logged in and connected; the gateway phase (READY and guild data) runs until on_ready
+    if "login" not in startup.phases:
+        startup.mark("login")
+
+def shard_health_rows():
+    """One health row per shard run by this process."""
+    now = time.time()
+    guilds = {}
+    for guild in bot.guilds:
+        guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+
+    def latency(seconds):
+        return None if seconds != seconds else seconds  # NaN until the first heartbeat
+
+    if not SHARDED:
+        status = "ready" if bot.is_ready() else "connecting"
+        return [{"shard_id": 0, "cluster_id": CLUSTER_ID, "pid": os.getpid(), "status": status,
+                 "guilds": len(bot.guilds), "latency": latency(bot.latency), "updated_at": now}]
+    return [
+        {"shard_id": shard_id, "cluster_id": CLUSTER_ID, "pid": os.getpid(),
+         "status": "disconnected" if shard.is_closed() else "ready",
+         "guilds": guilds.get(shard_id, 0), "latency": latency(shard.latency), "updated_at": now}
+        for shard_id, shard in sorted(bot.shards.items())
+    ]
 
-    # Check if the guild has reaction roles
-    guild_settings = settings.get(guild_id, {})
-    if "reaction_roles" not in guild_settings:
-        return
 
-    emoji = str(payload.emoji)
-    role_id = guild_settings["reaction_roles"].get(emoji)
+@tasks.loop(seconds=SHARD_HEALTH_INTERVAL)
+async def shard_health_task():
+    """Reports this process's shards, so any process can show the health of all of them."""
+    await run_write(storage, storage.put_shard_health, shard_health_rows())
+
+
+# Started once, on the first on_ready
+loop_lag_task = None
+metrics_server = None
+
+
+def start_metrics():
+    global loop_lag_task, metrics_server
+    if loop_lag_task is None:
+        loop_lag_task = asyncio.ensure_future(metrics.monitor_loop_lag())
+    if metrics_server is None and METRICS_PORT:
+        metrics_server = metrics.serve(asyncio.get_running_loop(), METRICS_HOST, METRICS_PORT)
+        print(f"✅ Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    # Runs whether or not the command raised
+    status = "error" if ctx.command_failed else "ok"
+    metrics.observe("milo_command_seconds", time.perf_counter() - ctx.started_at, command=ctx.command.qualified_name)
+    metrics.inc("milo_commands_total", command=ctx.command.qualified_name, status=status)
+
+
+def collect_metrics():
+    """Values kept by the bot's caches and queues, read when metrics are rendered."""
+    roles = auto_roles.stats()
+    rows = [
+        ("milo_ai_requests_started_total", {}, ai_scheduler.started, "counter"),
+        ("milo_ai_requests_rejected_total", {}, ai_scheduler.rejected, "counter"),
+        ("milo_ai_requests_shared_total", {}, ai_requests.shared, "counter"),
+        ("milo_ai_queue_length", {}, len(ai_scheduler), "gauge"),
+        ("milo_auto_roles_total", {"result": "assigned"}, roles["assigned"], "counter"),
+        ("milo_auto_roles_total", {"result": "skipped"}, roles["skipped"], "counter"),
+        ("milo_auto_roles_total", {"result": "failed"}, roles["failed"], "counter"),
+        ("milo_auto_role_queue_length", {}, roles["queued"], "gauge"),
+        ("milo_welcome_messages_total", {}, welcomes.messages, "counter"),
+        ("milo_postcard_dms_total", {"result": "delivered"}, postcard_dms.counts["delivered"], "counter"),
+        ("milo_postcard_dms_total", {"result": "forbidden"}, postcard_dms.counts["forbidden"], "counter"),
+        ("milo_postcard_dms_total", {"result": "failed"}, postcard_dms.counts["failed"], "counter"),
+        ("milo_postcard_mailboxes", {}, len(mailboxes), "gauge"),
+        ("milo_guilds", {}, len(bot.guilds), "gauge"),
+    ]
+    if bot.latency == bot.latency:  # NaN until the first heartbeat
+        rows.append(("milo_gateway_latency_seconds", {}, bot.latency, "gauge"))
+    # Don't load the AI cache just to report on it
+    if response_cache is not None:
+        cache = response_cache.stats()
+        rows += [
+            ("milo_ai_cache_hits_total", {}, cache["hits"], "counter"),
+            ("milo_ai_cache_misses_total", {}, cache["misses"], "counter"),
+            ("milo_ai_cache_evictions_total", {}, cache["evictions"], "counter"),
+            ("milo_ai_cache_entries", {}, cache["entries"], "gauge"),
+            ("milo_ai_cache_bytes", {}, cache["bytes"], "gauge"),
+        ]
+    for row in shard_health_rows():
+        if row["latency"] is not None:
+            rows.append(("milo_shard_latency_seconds", {"shard": row["shard_id"]}, row["latency"], "gauge"))
+    rows += [("milo_startup_seconds", {"phase": phase}, seconds, "gauge") for phase, seconds in startup.phases.items()]
+    rows += [("milo_first_load_seconds", {"store": name}, seconds, "gauge") for name, seconds in startup.loads.items()]
+    for name, stage in message_pipeline.stats().items():
+        rows.append(("milo_pipeline_stage_calls_total", {"stage": name}, stage["calls"], "counter"))
+    cats = cat_buffer.stats()
+    rows += [
+        ("milo_cat_buffer_size", {}, cats["buffered"], "gauge"),
+        ("milo_cat_buffer_served_total", {}, cats["served"], "counter"),
+        ("milo_cat_buffer_empty_total", {}, cats["empty"], "counter"),
+        ("milo_cat_buffer_errors_total", {}, cats["errors"], "counter"),
+    ]
+    members = member_cache.stats()
+    rows += [
+        ("milo_member_cache_size", {}, members["cached"], "gauge"),
+        ("milo_member_cache_hits_total", {}, members["hits"], "counter"),
+        ("milo_member_cache_misses_total", {}, members["misses"], "counter"),
+        ("milo_member_requests_total", {}, members["requests"], "counter"),
+        ("milo_member_cache_evictions_total", {}, members["evictions"], "counter"),
+    ]
+    pools = {"gif": gif_pool.stats(), "image": image_pool.stats()}
+    for stat in ("hits", "misses", "refreshes"):
+        rows += [(f"milo_result_pool_{stat}_total", {"pool": pool}, values[stat], "counter") for pool, values in pools.items()]
+    rows += [("milo_result_pool_queries", {"pool": pool}, values["queries"], "gauge") for pool, values in pools.items()]
+    return rows
 
-    if not role_id:
-        return
 
-    # Get the role object
-    role = discord.utils.get(member.guild.roles, id=role_id)
+metrics.collectors.append(collect_metrics)
 
-    if role:
-        try:
-            await member.remove_roles(role)
-            print(f"✅ Removed role '{role.name}' from {member.name} for emoji '{emoji}'")
-        except discord.DiscordException as e:
-            print(f"❌ Error removing role: {str(e)}")
-    else:
-        print(f"❌ Role with ID '{role_id}' not found!")
 
-@bot.event
-async def on_raw_reaction_add(payload):
-    """Handles role assignment when a user reacts to a message."""
-    guild_id = str(payload.guild_id)
-    member = await bot.guilds[0].fetch_member(payload.user_id)
-    settings = load_settings()
-
-    # Check if the guild has reaction roles
-    guild_settings = settings.get(guild_id, {})
-    if "reaction_roles" not in guild_settings:
-        return
-
-    emoji = str(payload.emoji)  # Convert emoji to string
-    role_id = guild_settings["reaction_roles"].get(emoji)
+async def get_reaction_role(payload):
+    """Returns (member, role) if the reaction is a reaction role, otherwise (None, None)."""
+    if payload.guild_id is None:
+        return None, None
 
+    # Most reactions aren't on reaction role messages, so check the index before anything else
+    role_id = reaction_roles.lookup(payload.guild_id, payload.message_id, str(payload.emoji))
     if not role_id:
-        return
+        return None, None
 
-    # Get the role object
-    role = discord.utils.get(member.guild.roles, id=role_id)
+    guild = bot.get_guild(payload.guild_id)
+    if guild is None:
+        return None, None
 
-    if role:
-        try:
-            await member.add_roles(role)
-            print(f"✅ Assigned role '{role.name}' to {member.name} for emoji '{emoji}'")
-        except discord.DiscordException as e:
-            print(f"❌ Error assigning role: {str(e)}")
-    else:
+    role = guild.get_role(role_id)
+    if not role:
         print(f"❌ Role with ID '{role_id}' not found!")
+        return None, None
+
+    # Reaction adds include the member; removals need a lookup (batched with any others)
+    if payload.member is not None:
+        member = payload.member
+        member_cache.remember(member)
+    else:
+        member = await member_cache.fetch(guild, payload.user_id)
+    if member is None or member.bot:
+        return None, None
+    return member, role
+
+
+@bot.event
+@metrics.timed_event
+async def on_raw_reaction_remove(payload):
+    """Handles role removal when a user removes a reaction from a message."""
+    member, role = await get_reaction_role(payload)
+    if member:
+        role_changes.remove(member, role)
+
+@bot.event
+@metrics.timed_event
+async def on_raw_reaction_add(payload):
+    """Handles role assignment when a user reacts to a message."""
+    member, role = await get_reaction_role(payload)
+    if member:
+        role_changes.add(member, role)
 
 @bot.event
 async def on_command_error(ctx, error):
@@ -460,7 +825,8 @@ async def addstaff(ctx, member: discord.Member):
     """Adds a user to the staff role (only accessible to the server owner or staff)."""
 
     # Check if the user is the server owner or has the 'Staff' role
-    if ctx.author == ctx.guild.owner or "Staff" in [role.name for role in ctx.author.roles]:
+    # Compare ids: the owner's member object is only cached with MEMBER_CACHE=full
+    if ctx.author.id == ctx.guild.owner_id or "Staff" in [role.name for role in ctx.author.roles]:
         staff_role = discord.utils.get(ctx.guild.roles, name="Staff")
 
         # If the 'Staff' role doesn't exist, create one
@@ -515,17 +881,27 @@ async def ticket(ctx):
         
     }
 
+    flow = Flow("Creating your ticket...")
+
     # Create the ticket channel
-    ticket_channel = await guild.create_text_channel(ticket_name, overwrites=overwrites)
+    @flow.step("Channel")
+    async def create_channel():
+        return await guild.create_text_channel(ticket_name, overwrites=overwrites)
 
     # Notify staff about the new ticket
-    staff_role = discord.utils.get(guild.roles, name="Staff")
-    if staff_role:
+    @flow.step("Staff notified", after=("Channel",))
+    async def notify_staff(ticket_channel):
+        staff_role = discord.utils.get(guild.roles, name="Staff")
+        if not staff_role:
+            return "no Staff role on this server"
         await ticket_channel.send(f"Hello {ctx.author.mention}, this is your ticket! A staff member will assist you shortly.")
         await ticket_channel.send(f"Hey {staff_role.mention}, a new ticket has been created by {ctx.author.mention}.")
 
-    # Send a message in the original channel notifying the user
-    await ctx.send(f"Your ticket has been created! {ticket_channel.mention}")
+    # Show progress in the original channel, then point the user to their ticket
+    if await flow.run(ctx.channel):
+        await flow.finish(f"Your ticket has been created! {flow.result('Channel').mention}")
+    else:
+        await flow.finish("❌ I couldn't create your ticket. Please ask a staff member for help.")
 
 
 @bot.command()
@@ -558,14 +934,15 @@ async def rr(ctx, message_id: int, emoji: str, *, role: discord.Role):
     if guild_id not in settings:
         settings[guild_id] = {}
 
-    # Store reaction-role mapping
+    # Store reaction-role mapping for this message
     if "reaction_roles" not in settings[guild_id]:
         settings[guild_id]["reaction_roles"] = {}
 
-    settings[guild_id]["reaction_roles"][emoji] = role.id
+    settings[guild_id]["reaction_roles"].setdefault(str(message_id), {})[emoji] = role.id
 
-    # Save settings
-    save_settings(settings)
+    # Save settings and update the reaction role index
+    save_guild_settings(guild_id)
+    reaction_roles.rebuild_guild(guild_id, settings[guild_id])
 
 # Command: Set Auto Role
 @bot.command()
@@ -597,8 +974,8 @@ async def setwelcome(ctx, channel: discord.TextChannel = None, *, message: str):
     else:
         await ctx.send("✅ Welcome message updated! It will be sent in the first available channel.")
 
-    # Save settings to file
-    save_settings(settings)
+    # Save settings
+    save_guild_settings(guild_id)
 
 
 # Command: Set Custom AI Prompt
@@ -614,9 +991,7 @@ async def setaiprompt(ctx, *, prompt: str):
 @commands.has_permissions(administrator=True)
 async def viewsettings(ctx):
     """Displays the current server settings."""
-    settings = load_settings()
-    guild_id = str(ctx.guild.id)
-    guild_settings = settings.get(guild_id, {})
+    guild_settings = get_guild_settings(ctx.guild.id)
 
     if not guild_settings:
         await ctx.send("⚠ No settings configured for this server.")
@@ -628,20 +1003,27 @@ async def viewsettings(ctx):
 
 @bot.command()
 async def modsetup(ctx):
-    if ctx.author.guild_permissions.manage_channels:
-        # Create a new text channel
-        await ctx.send("Setting up the bot...")
-        await ctx.guild.create_text_channel('path mod logs')
-        await ctx.send(f"✅ Channels have been created.")
-        time.sleep(1)
-        await ctx.send(f"✅ Commands have been setup.")
-        time.sleep(1)
+    if not ctx.author.guild_permissions.manage_channels:
         await ctx.send(
-            f"✅ Setup Complete. To view a list of commands, run **;helpcommand**"
+            "❌ I don't have permission to create a channel. Please make sure I have the necessary permissions, and run this command again."
         )
+        return
+
+    flow = Flow("Setting up the bot...")
+
+    # Create a new text channel
+    @flow.step("Channels")
+    async def create_channels():
+        if discord.utils.get(ctx.guild.text_channels, name="path-mod-logs"):
+            return "#path-mod-logs already exists"
+        await ctx.guild.create_text_channel('path mod logs')
+        return "created #path-mod-logs"
+
+    if await flow.run(ctx.channel):
+        await flow.finish("✅ Setup Complete. To view a list of commands, run **;helpcommand**")
     else:
-        await ctx.send(
-            "❌ I don't have permission to create a channel. Please make sure I have the necessary permissions, and run this command again."
+        await flow.finish(
+            "❌ Setup didn't finish. Please make sure I have the necessary permissions, and run this command again."
         )
 
 
@@ -652,33 +1034,34 @@ async def riggedcoinflip(ctx):
 
 @bot.command()
 async def image(ctx, *, query):
-    await ctx.send(get_pixabay_image(query))
+    await ctx.send(await get_pixabay_image(query) or "No images found or error occurred.")
 
 
 @bot.command()
 async def gif(ctx, *, query):
     tenorapikey = os.getenv('TENOR_API')
     clientkey = "The_Path"
-    await ctx.send(get_random_gif(query, tenorapikey, clientkey))
+    await ctx.send(await get_random_gif(query, tenorapikey, clientkey))
 
 
 @bot.command()
 async def ai(ctx, *, user_input: str):
     async with ctx.typing():
         # Check if the response is already cached
-        if user_input in response_cache:
-            response = response_cache[user_input]
-        else:
+        cache_key = ai_cache_key(ctx.guild, user_input)
+        response = get_response_cache().get(cache_key)
+        reply = StreamingReply(ctx.channel, AI_STREAM_EDIT_INTERVAL) if AI_STREAMING else None
+        if not response:
             try:
-                # Get AI response from the get_ai function
-                response = get_ai(user_input)
-    
-                # Cache the response for future use
-                response_cache[user_input] = response
-    
-                # Save the updated cache to the file
-                save_cache(response_cache)
+                # Get AI response (shared with identical requests in flight) and cache it
+                response = await fetch_ai_response(
+                    cache_key, user_input, ctx.guild.id if ctx.guild else None,
+                    on_queued=lambda position: ctx.send(f"⏳ The AI is busy, you're queued at position {position}."),
+                    on_text=reply.update if reply else None)
     
+            except AIQueueFull:
+                await ctx.send("Sorry, too many people are using the AI right now. Please try again in a minute.")
+                return
             except Exception as e:
                 # Check if it's a rate limit error (Error code: 429)
                 website = os.getenv('Website')
@@ -688,13 +1071,121 @@ async def ai(ctx, *, user_input: str):
                     )
                     # Log the error for debugging
                     print(f"Rate limit error: {e}")
+                    return
                 else:
                     # For other errors, simply send an error message
                     await ctx.send(f"An error occurred: {e}")
                     return
     
-        # Send the AI response in the original channel
-        await ctx.send(response)
+        # Discord rejects empty messages
+        if not response or not response.strip():
+            response = "🤔 The AI didn't come up with an answer. Please try asking in a different way."
+
+        # Send the AI response in the original channel (or finish the streamed message)
+        if reply:
+            await reply.finish(response)
+        else:
+            await ctx.send(response)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def aicachestats(ctx):
+    """Shows hit/miss counters for the AI response cache."""
+    stats = get_response_cache().stats()
+    await ctx.send(
+        f"🧠 **AI Cache:** {stats['entries']} entries ({stats['bytes'] // 1024} KB)\n"
+        f"Hits: {stats['hits']} | Misses: {stats['misses']} | Hit rate: {stats['hit_rate']:.0%}\n"
+        f"Evictions: {stats['evictions']} | Expired: {stats['expirations']}"
+    )
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    """Shows command latency, upstream API health, cache hit rates and event loop lag."""
+    def timing(histogram):
+        return f"avg {histogram.sum / histogram.count * 1000:.0f}ms | p95 {histogram.quantile(0.95) * 1000:.0f}ms"
+
+    uptime = int(time.time() - metrics.started)
+    lines = [f"📊 **Stats** (up {uptime // 3600}h {uptime % 3600 // 60}m, {len(bot.guilds)} servers)"]
+
+    lag = metrics.histogram("milo_event_loop_lag_seconds")
+    if lag:
+        lines.append(f"**Event loop lag:** p95 {lag.quantile(0.95) * 1000:.0f}ms | max {lag.max * 1000:.0f}ms")
+
+    command_times = sorted(
+        ((dict(labels)["command"], histogram) for (name, labels), histogram in metrics.histograms.items()
+         if name == "milo_command_seconds"),
+        key=lambda item: item[1].count, reverse=True)
+    if command_times:
+        lines.append("**Top commands:**")
+        lines.extend(f"`;{command}` ×{histogram.count} – {timing(histogram)}" for command, histogram in command_times[:8])
+
+    upstreams = [(dict(labels)["service"], histogram) for (name, labels), histogram in metrics.histograms.items()
+                 if name == "milo_upstream_seconds"]
+    if upstreams:
+        lines.append("**Upstream APIs:**")
+        for service, histogram in sorted(upstreams):
+            errors = sum(value for (name, labels), value in metrics.counters.items()
+                         if name == "milo_upstream_responses_total" and dict(labels)["service"] == service
+                         and dict(labels)["status"] not in ("200", "ok"))
+            lines.append(f"{service}: ×{histogram.count} – {timing(histogram)} | {errors} errors")
+
+    cache = get_response_cache().stats()
+    lines.append(f"**AI cache:** {cache['hit_rate']:.0%} hit rate ({cache['hits']} hits, {cache['misses']} misses)")
+
+    members = member_cache.stats()
+    lines.append(f"**Member cache ({MEMBER_CACHE}):** {members['cached']} kept | {members['hit_rate']:.0%} hit rate | "
+                 f"{members['requests']} lookups sent")
+
+    pipeline = message_pipeline.stats()
+    lines.append("**Message pipeline:** " + " | ".join(
+        f"{name} {stage['avg_ms']:.1f}ms" for name, stage in pipeline.items()))
+
+    await ctx.send("\n".join(lines))
+
+
+@bot.command()
+async def shards(ctx):
+    """Shows the health of every shard, including the ones run by other processes."""
+    # One row per shard; WAL readers don't wait for writers
+    rows = storage.load_shard_health()  # blocking: ok
+    if not rows:
+        await ctx.send("No shard has reported yet.")
+        return
+
+    now = time.time()
+    lines = ["🛰️ **Shards:**"]
+    for row in rows:
+        # A process that stopped reporting is probably down
+        if now - row["updated_at"] > SHARD_HEALTH_INTERVAL * 3:
+            status = f"💀 no report for {int(now - row['updated_at'])}s"
+        elif row["status"] == "ready":
+            status = "✅ ready"
+        else:
+            status = f"⚠️ {row['status']}"
+        latency = f"{row['latency'] * 1000:.0f}ms" if row["latency"] is not None else "?"
+        here = " (this one)" if ctx.guild and ctx.guild.shard_id == row["shard_id"] else ""
+        lines.append(f"Shard {row['shard_id']}{here}: {status} | {row['guilds']} servers | {latency} | "
+                     f"cluster {row['cluster_id']} (pid {row['pid']})")
+    lines.append(f"**Total:** {sum(row['guilds'] for row in rows)} servers on {len(rows)} shards")
+    for chunk in split_message("\n".join(lines)):
+        await ctx.send(chunk)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def joinstats(ctx):
+    """Shows counters for welcome batching and the auto role queue."""
+    stats = auto_roles.stats()
+    await ctx.send(
+        f"👋 **Welcomes:** {welcomes.members} members in {welcomes.messages} messages\n"
+        f"**Auto roles:** {stats['assigned']} assigned | {stats['skipped']} skipped | {stats['failed']} failed | "
+        f"{stats['retries']} retries\n"
+        f"Queue: {stats['queued']} waiting (max {stats['max_depth']}) | Backpressure waits: {stats['backpressure_waits']} | "
+        f"Avg wait: {stats['avg_wait']:.1f}s"
+    )
 
 
 @bot.command()
@@ -738,7 +1229,7 @@ async def magic(ctx):
 
 @bot.command()
 async def cat(ctx):
-    await ctx.reply(get_cat())
+    await ctx.reply(await get_cat() or "😿 I couldn't find a cat right now, please try again in a minute.")
 
 
 @bot.command()
@@ -761,45 +1252,56 @@ async def sendpostcard(ctx, recipient: discord.User, *, message=None):
     """
     Sends a postcard to a recipient with a custom message or randomly generated one.
     """
-    # List of random postcard messages if no custom message is provided
-    random_postcards = [
-        "Greetings from Paris! 🗼✨ Hope you enjoy the Eiffel Tower and the local croissants!",
-        "A sunny day in Bali! 🌴🌊 Don't forget to visit the temples and beaches!",
-        "Exploring Tokyo! 🏙️🍣 Amazing food and an awesome blend of tradition and technology!",
-        "Cheers from London! 🎡🌧️ Be sure to visit the Tower of London and Big Ben!",
-        "Wanderlust in New York City! 🗽🌆 Enjoy the skyline and the amazing parks!"
-    ]
+    final_message = make_postcard(ctx.author, message)
 
-    # If no message is provided, choose a random postcard
-    if not message:
-        message = random.choice(random_postcards)
+    # Put the postcard in the recipient's mailbox, unless it's full
+    if not mailboxes.send(recipient.id, final_message):
+        await ctx.send(f"❌ {recipient.mention}'s mailbox is full! They need to open their postcards first.")
+        return
+    await ctx.send(f"✅ Postcard sent to {recipient.mention}!")
 
-    # Append the "from" message at the end of the postcard
-    from_message = f"\n\nFrom: {ctx.author.name} ({ctx.author.mention})"
+    # Notify the recipient via DM (queued, so a slow DM doesn't hold anything up)
+    if await postcard_dms.submit(recipient, postcard_notification(ctx.author)) == FORBIDDEN:
+        await ctx.send(
+            f"❌ Could not send a DM to {recipient.mention}. Please make sure their DMs are open."
+        )
 
-    # Final postcard message
-    final_message = message + from_message
 
-    # If the recipient already has postcards, append to the list, otherwise create a new list
-    if recipient.id not in postcard_storage:
-        postcard_storage[recipient.id] = []
+@bot.command(name="bulkpostcard")
+@commands.has_permissions(manage_guild=True)
+async def bulkpostcard(ctx, targets: commands.Greedy[typing.Union[discord.Role, discord.Member]], *, message=None):
+    """
+    Sends the same postcard to every member of the given roles and to the given members.
+    """
+    roles = [target for target in targets if isinstance(target, discord.Role)]
+    members = [target for target in targets if not isinstance(target, discord.Role)]
+    if roles:
+        members += await member_cache.members_with_roles(ctx.guild, roles)
+    recipients = {member.id: member for member in members if not member.bot}
+    if not recipients:
+        await ctx.send("❌ Tell me who to send postcards to, e.g. `;bulkpostcard @Role @member Hello!`")
+        return
 
-    # Append the new postcard message to the recipient's list
-    postcard_storage[recipient.id].append(final_message)
+    final_message = make_postcard(ctx.author, message)
+    status = await ctx.send(f"📮 Sending postcards to {len(recipients)} members...")
 
-    # Save the updated postcards to the JSON file
-    save_postcards(postcard_storage)
+    # Every postcard is stored before any DM goes out
+    stored, full = mailboxes.send_many(list(recipients), final_message)
+    report = await postcard_dms.deliver_all([recipients[member_id] for member_id in stored],
+                                            postcard_notification(ctx.author))
 
-    # Notify the recipient via DM
-    try:
-        await recipient.send(
-            f"📬 You've received a new postcard from {ctx.author.name} ({ctx.author.mention})! Use `;openpostcard` to view your postcards. 🎉"
-        )
-        await ctx.send(f"✅ Postcard sent to {recipient.mention}!")
-    except discord.Forbidden:
-        await ctx.send(
-            f"❌ Could not send a DM to {recipient.mention}. Please make sure their DMs are open."
-        )
+    summary = (
+        f"📮 **Postcards sent to {len(stored)} of {len(recipients)} members**\n"
+        f"✅ Notified: {len(report['delivered'])}\n"
+        f"🔒 DMs closed: {len(report['forbidden'])}\n"
+        f"📭 Mailbox full: {len(full)}\n"
+        f"❌ DM failed: {len(report['failed'])}"
+    )
+    if report["forbidden"]:
+        names = ", ".join(member.name for member in report["forbidden"][:20])
+        more = len(report["forbidden"]) - 20
+        summary += f"\nDMs closed for: {names}" + (f" and {more} more" if more > 0 else "")
+    await status.edit(content=summary)
 
 
 @bot.command(name="openpostcard")
@@ -807,32 +1309,28 @@ async def openpostcard(ctx):
     """
     Allows a recipient to view their postcards.
     """
-    # Check if the user has any postcards stored
-    if ctx.author.id in postcard_storage and postcard_storage[ctx.author.id]:
-        # Retrieve the list of postcards
-        messages = postcard_storage[ctx.author.id]
-
-        # Construct the message to send all postcards
-        response = "🌍 Here are your postcards:\n"
-        for index, message in enumerate(messages, start=1):
-            response += f"**Postcard {index}:** {message}\n"
-
-        # Send the postcards
-        await ctx.message.reply(response)
-
-        del postcard_storage[ctx.author.id]
+    # Get the user's postcards from their mailbox
+    postcards = mailboxes.open(ctx.author.id)
+    if not postcards:
+        await ctx.send("❌ You don’t have any postcards to open!")
+        return
 
-        # Save the updated postcards to the JSON file after deletion
-        save_postcards(postcard_storage)
+    # Send the postcards, a page at a time if they don't fit in one message
+    pages = PostcardPages(ctx.author.id, postcards, POSTCARD_PAGE_SIZE)
+    if len(pages.pages) > 1:
+        pages.message = await ctx.message.reply(embed=pages.embed(), view=pages)
     else:
-        await ctx.send("❌ You don’t have any postcards to open!")
+        await ctx.message.reply(embed=pages.embed())
+
+    # Only empty the mailbox once the postcards were shown, so a failed reply doesn't lose them
+    mailboxes.remove(ctx.author.id, postcards)
 
 
 @bot.command()
 async def balance(ctx):
     guild_id = ctx.guild.id
     user_id = ctx.author.id
-    money = get_balance(guild_id, user_id)
+    money = await ledger.balance(guild_id, user_id)
     await ctx.send(
         f"💰 {ctx.author.name}, you have **{money} miles** in this server.")
 
@@ -848,8 +1346,7 @@ async def give(ctx, member: discord.Member, amount: int):
     user_id = ctx.author.id
     target_id = member.id
 
-    if remove_money(guild_id, user_id, amount):
-        add_money(guild_id, target_id, amount)
+    if await ledger.transfer(guild_id, user_id, target_id, amount):
         await ctx.send(
             f"✅ {ctx.author.name} gave {amount} gems to {member.name}.")
     else:
@@ -859,86 +1356,79 @@ async def give(ctx, member: discord.Member, amount: int):
 # 🏆 Command: Currency leaderboard (server-specific)
 @bot.command()
 async def gemboard(ctx):
-    guild_id = str(ctx.guild.id)
-    data = load_currency()
-
-    # If no currency data for the server, create an entry for it
-    if guild_id not in data:
-        data[guild_id] = {}
-        # Save the updated data with the server entry
-        save_currency(data)
+    top_users = gem_boards.get(ctx.guild.id).top(10)  # Top 10 users
 
-        await ctx.send(
-            "No currency data for this server yet. Creating a new entry.")
+    # If no currency data for the server, there is nothing to rank yet
+    if not top_users:
+        await ctx.send("No currency data for this server yet.")
+        return
 
-    # Sort users by mileage (just miles)
-    sorted_users = sorted(data[guild_id].items(),
-                          key=lambda x: x[1]['miles'],
-                          reverse=True)
+    names = await user_names.resolve(bot, ctx.guild, [user_id for user_id, _ in top_users])
 
     leaderboard_message = "🏆 **Richest in This Server** 🏆\n\n"
 
-    for idx, (user_id,
-              user_data) in enumerate(sorted_users[:10]):  # Top 10 users
-        user = await bot.fetch_user(int(user_id))
-        leaderboard_message += f"**{idx + 1}. {user.name}** - {user_data['miles']} gems\n"
+    for idx, (user_id, miles) in enumerate(top_users):
+        leaderboard_message += f"**{idx + 1}. {names[user_id]}** - {miles} gems\n"
+
+    await ctx.send(leaderboard_message)
+
+
+async def top_members(guild, board, n):
+    """The top n of a board with users from every server, keeping only members of this one."""
+    top = []
+    checked = 0
+    # Check membership 100 candidates at a time, in one lookup each
+    while len(top) < n and checked < LEVELBOARD_MAX_CANDIDATES:
+        candidates = board.top(checked + 100)[checked:]
+        if not candidates:
+            break
+        checked += len(candidates)
+        members = await member_cache.fetch_many(guild, [int(user_id) for user_id, _ in candidates])
+        top += [(user_id, score) for user_id, score in candidates if int(user_id) in members]
+    return top[:n]
+
+
+# 🏆 Command: XP leaderboard (members of this server)
+@bot.command()
+async def levelboard(ctx):
+    load_user_xp()
+    top_users = await top_members(ctx.guild, xp_tracker.board, 10)
+
+    if not top_users:
+        await ctx.send("Nobody in this server has earned any XP yet!")
+        return
+
+    names = await user_names.resolve(bot, ctx.guild, [user_id for user_id, _ in top_users])
+
+    leaderboard_message = "⭐ **Top Levels in This Server** ⭐\n\n"
+
+    for idx, (user_id, (user_level, xp)) in enumerate(top_users):
+        leaderboard_message += f"**{idx + 1}. {names[user_id]}** - level {user_level} ({xp} XP)\n"
 
     await ctx.send(leaderboard_message)
 
 
 @bot.command()
 async def level(ctx):
-    data = read_user_data()
     user_id = str(ctx.author.id)
-    if user_id not in data:
+    if user_id not in load_user_xp():
         await ctx.send(f"{ctx.author.name}, you haven't earned any XP yet!")
         return
 
-    user_data = data[user_id]
+    user_data = xp_tracker.user_xp[user_id]
     await ctx.send(
         f"{ctx.author.name}, you are level {user_data['level']} with {user_data['xp']} XP."
     )
 
 
-# Event when a user sends a message
-@bot.event
-async def on_message(message):
-    if message.author.bot:
-        return
-
-    # Give random XP between 10 and 20
-    xp_earned = random.randint(10, 20)
-
-    # Update XP and level for the user
-    update_xp(str(message.author.id), xp_earned)
-
-    await bot.process_commands(
-        message)  # Allows commands to work even with on_message
-
-
 @bot.command()
 async def daily(ctx):
     user_id = str(ctx.author.id)
     guild_id = str(ctx.guild.id)
 
-    # Load currency data
-    try:
-        with open("currency.json", "r") as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        data = {}
-
-    # Ensure user exists in the system
-    if guild_id not in data:
-        data[guild_id] = {}
-    if user_id not in data[guild_id]:
-        data[guild_id][user_id] = {"miles": 0, "last_flight": 0}
-
-    # Check if 24 hours have passed since the last flight
-    current_time = time.time()
-    if current_time - data[guild_id][user_id]["last_flight"] < 86400:
-        time_left = 86400 - (current_time -
-                             data[guild_id][user_id]["last_flight"])
+    # Give 500 miles if 24 hours have passed since the last flight
+    claimed, time_left = await ledger.claim_daily(guild_id, user_id, 500, 86400)
+    if not claimed:
         hours_left = int(time_left // 3600)
         minutes_left = int((time_left % 3600) // 60)
         await ctx.send(
@@ -946,14 +1436,6 @@ async def daily(ctx):
         )
         return
 
-    # Give 500 miles and update last flight time
-    data[guild_id][user_id]["miles"] += 500
-    data[guild_id][user_id]["last_flight"] = current_time
-
-    # Save updated data
-    with open("currency.json", "w") as f:
-        json.dump(data, f, indent=4)
-
     await ctx.send(
         f"✈️ {ctx.author.mention}, You earned **500 gems**! Come back in 24 hours for another 500."
     )
@@ -973,11 +1455,16 @@ async def addcommand(ctx, command_name: str, *, response: str):
     if "custom_commands" not in settings[guild_id]:
         settings[guild_id]["custom_commands"] = {}
 
-    # Add the new custom command to the guild's settings
-    settings[guild_id]["custom_commands"][command_name] = response
+    # Add the new custom command to the guild's settings (keeping aliases and cooldown if it already exists)
+    existing = settings[guild_id]["custom_commands"].get(command_name)
+    if isinstance(existing, dict):
+        existing["response"] = response
+    else:
+        settings[guild_id]["custom_commands"][command_name] = response
 
-    # Save the settings back to the file
-    save_settings(settings)
+    # Save the settings and recompile the guild's custom commands
+    save_guild_settings(guild_id)
+    custom_commands.rebuild_guild(guild_id, settings[guild_id])
 
     await ctx.send(f"✅ Custom command `{command_name}` added successfully!")
 
@@ -995,41 +1482,135 @@ async def removecommand(ctx, command_name: str):
 
     if command_name in settings[guild_id]["custom_commands"]:
         del settings[guild_id]["custom_commands"][command_name]
-        save_settings(settings)
+        save_guild_settings(guild_id)
+        custom_commands.rebuild_guild(guild_id, settings[guild_id])
         await ctx.send(f"✅ Custom command `{command_name}` removed successfully!")
     else:
         await ctx.send(f"❌ Command `{command_name}` not found.")
 
-# Event to handle custom commands
-@bot.event
-async def on_message(message):
-    # Prevent the bot from responding to itself
-    if message.author == bot.user:
+
+def get_custom_command_config(guild_id, command_name):
+    """Returns the stored custom command as a dict (converting the plain string format), or None."""
+    stored_commands = get_guild_settings(guild_id).get("custom_commands", {})
+    if command_name not in stored_commands:
+        return None
+    config = normalize_command(stored_commands[command_name])
+    stored_commands[command_name] = config
+    return config
+
+
+# Command to add an alias for a custom command
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def addalias(ctx, command_name: str, alias: str):
+    """Lets a custom command also be triggered by another name."""
+    config = get_custom_command_config(ctx.guild.id, command_name)
+    if config is None:
+        await ctx.send(f"❌ Command `{command_name}` not found.")
         return
 
-    # Get the guild settings
-    settings = load_settings()
-    guild_id = str(message.guild.id)
+    if alias not in config["aliases"]:
+        config["aliases"].append(alias)
+    save_guild_settings(ctx.guild.id)
+    custom_commands.rebuild_guild(ctx.guild.id, get_guild_settings(ctx.guild.id))
+    await ctx.send(f"✅ `{alias}` now runs `{command_name}`.")
+
+
+# Command to set a per-user cooldown on a custom command
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def setcooldown(ctx, command_name: str, seconds: int):
+    """Sets how long each user must wait between uses of a custom command (0 to remove)."""
+    config = get_custom_command_config(ctx.guild.id, command_name)
+    if config is None:
+        await ctx.send(f"❌ Command `{command_name}` not found.")
+        return
+
+    config["cooldown"] = max(seconds, 0)
+    save_guild_settings(ctx.guild.id)
+    custom_commands.rebuild_guild(ctx.guild.id, get_guild_settings(ctx.guild.id))
+    await ctx.send(f"✅ Cooldown for `{command_name}` set to {config['cooldown']} seconds.")
+
+# Message handling: every message runs through these stages in order, once
+message_pipeline = MessagePipeline()
+
 
-    # Check if custom commands are defined for this guild
-    if guild_id in settings and "custom_commands" in settings[guild_id]:
-        custom_commands = settings[guild_id]["custom_commands"]
+@message_pipeline.stage("bot filter")
+async def ignore_bots(message):
+    # Prevent the bot from responding to itself or other bots
+    return message.author.bot
 
-        # Check if the message content matches any custom command
-        if message.content in custom_commands:
-            response = custom_commands[message.content]
 
-            # Replace {user.mention} and {user.name} with actual user details
-            response = response.replace("{user.mention}", message.author.mention)
-            response = response.replace("{user.name}", message.author.name)
+@message_pipeline.stage("member cache")
+async def remember_author(message):
+    # Authors of guild messages are the members worth keeping
+    member_cache.remember(message.author)
 
-            await message.channel.send(response)
-            return  # Stop here, don't process other commands after this
 
-    # Process regular commands (this is necessary to allow normal commands to work)
+@message_pipeline.stage("custom commands")
+async def run_custom_command(message):
+    # Get the guild's compiled custom commands (rebuilt only when they change)
+    table = custom_commands.tables.get(str(message.guild.id)) if message.guild else None
+    if not table:
+        return
+
+    # Check if the message content matches any custom command
+    command, args = custom_commands.match(table, message.content)
+    if command is None:
+        return
+
+    # Used too recently by this user: swallow the message quietly
+    if not command.on_cooldown(message.author.id):
+        await message.channel.send(command.render(message.author, args))
+    return True  # Stop here, don't process other commands after this
+
+
+@message_pipeline.stage("xp")
+async def award_xp(message):
+    # Give random XP between 10 and 20, at most once per cooldown per user
+    user_id = str(message.author.id)
+    now = time.monotonic()
+    if now - xp_last_awarded.get(user_id, -XP_COOLDOWN) < XP_COOLDOWN:
+        return
+    xp_last_awarded[user_id] = now
+
+    # Update XP and level for the user (in memory, flushed to storage in batches)
+    load_user_xp()
+    xp_tracker.award(user_id, random.randint(10, 20))
+
+
+@message_pipeline.stage("commands")
+async def run_commands(message):
+    # Process regular commands
     await bot.process_commands(message)
 
-    
+
+@bot.event
+@metrics.timed_event
+async def on_message(message):
+    await message_pipeline.run(message)
 
 
-bot.run(os.getenv('DISCORD_TOKEN'))
+async def main():
+    try:
+        async with bot:
+            await bot.start(os.getenv('DISCORD_TOKEN'))
+    finally:
+        # Close pooled HTTP connections while the event loop is still running
+        await close_session()
+        await ai_clients.close()
+
+
+startup.mark("load")
+
+# LOG_LEVEL=DEBUG also logs full upstream responses
+discord.utils.setup_logging(level=getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO))
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
+    pass
+finally:
+    # Make sure XP earned since the last flush is not lost on shutdown
+    xp_tracker.flush()
+    flush_cache()
+    storage.close()
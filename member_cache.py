@@ -0,0 +1,284 @@
+"""
+Which guild members are kept in memory, and how the others are looked up when they are needed.
+
+With the members intent, discord.py's default is to download every member of every guild at
+startup and keep them all, which dominates memory in large guilds. The bot only needs members
+for joins, reaction roles and leaderboards, so the profile (MEMBER_CACHE) decides what is kept:
+
+    full    discord.py's default: every member, guilds chunked at startup
+    lazy    no chunking at startup; discord.py keeps members as they join or are updated
+    lean    discord.py keeps no members; MemberCache keeps the most recently active ones
+
+Members that aren't cached are looked up through the gateway. Lookups for the same guild made
+within a short window are sent as one request (up to 100 members each).
+
+Usage:
+    python member_cache.py report [members] [active]    Memory used by each profile for a synthetic guild
+"""
+import asyncio
+import gc
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import discord
+
+PROFILES = ("full", "lazy", "lean")
+
+# Members per gateway member request (Discord's limit)
+QUERY_LIMIT = 100
+
+
+def cache_options(profile, intents):
+    """Returns the member_cache_flags and chunk_guilds_at_startup options for the bot."""
+    if profile == "full":
+        return discord.MemberCacheFlags.from_intents(intents), True
+    if profile == "lazy":
+        return discord.MemberCacheFlags.from_intents(intents), False
+    if profile == "lean":
+        return discord.MemberCacheFlags.none(), False
+    raise ValueError(f"Unknown member cache profile '{profile}', use one of: {', '.join(PROFILES)}")
+
+
+class MemberCache:
+    """
+    Recently active members (least recently seen evicted past `max_members`), on top of whatever
+    discord.py caches itself. Members kept here aren't updated by gateway events, so their roles
+    can be out of date; fetch() goes to discord.py's cache or the gateway instead.
+    """
+
+    def __init__(self, max_members=5000, batch_window=0.05, max_departed=1000):
+        self.max_members = max_members
+        self.batch_window = batch_window
+        self.max_departed = max_departed
+
+        # (guild_id, user_id) -> Member, least recently seen first
+        self._members = OrderedDict()
+        # (guild_id, user_id) of members who left recently
+        self._departed = OrderedDict()
+        # guild_id -> {user_id: future} waiting for the next gateway request
+        self._waiting = {}
+        # Running gateway requests, referenced so they can't be garbage collected mid-flight
+        self._tasks = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.fetched = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def __len__(self):
+        return len(self._members)
+
+    def remember(self, member):
+        """Call with every member seen in an event; keeps the freshest copy."""
+        if not isinstance(member, discord.Member):
+            return
+        key = (member.guild.id, member.id)
+        self._departed.pop(key, None)
+        self._members[key] = member
+        self._members.move_to_end(key)
+        while len(self._members) > self.max_members:
+            self._members.popitem(last=False)
+            self.evictions += 1
+
+    def forget(self, guild_id, user_id):
+        """Call when a member leaves the guild."""
+        key = (guild_id, user_id)
+        self._members.pop(key, None)
+        self._departed[key] = True
+        self._departed.move_to_end(key)
+        while len(self._departed) > self.max_departed:
+            self._departed.popitem(last=False)
+
+    def has_left(self, guild_id, user_id):
+        return (guild_id, user_id) in self._departed
+
+    def get(self, guild, user_id):
+        """Returns the member if it is cached by discord.py or here, without any API call."""
+        member = guild.get_member(user_id)
+        if member is None:
+            member = self._members.get((guild.id, user_id))
+            if member is not None:
+                self._members.move_to_end((guild.id, user_id))
+        return member
+
+    async def fetch(self, guild, user_id):
+        """
+        Returns an up-to-date member, or None if they aren't in the guild: from discord.py's cache
+        if it has them, otherwise from the gateway.
+        """
+        member = guild.get_member(user_id)
+        if member is not None:
+            self.hits += 1
+            return member
+        if guild.chunked:
+            # A chunked guild has every member cached, so a miss means they aren't in it
+            self.misses += 1
+            return None
+        return (await self._fetch(guild, [user_id])).get(user_id)
+
+    async def fetch_many(self, guild, user_ids):
+        """Returns {user_id: member} for those of the user ids that are in the guild, cached ones first."""
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            member = self.get(guild, user_id)
+            if member is not None:
+                self.hits += 1
+                found[user_id] = member
+            elif guild.chunked:
+                self.misses += 1
+            else:
+                missing.append(user_id)
+        if missing:
+            found.update(await self._fetch(guild, missing))
+        return found
+
+    async def _fetch(self, guild, user_ids):
+        self.misses += len(user_ids)
+        waiting = self._waiting.get(guild.id)
+        if waiting is None:
+            waiting = self._waiting[guild.id] = {}
+            asyncio.get_running_loop().call_later(self.batch_window, self._start_flush, guild)
+
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for user_id in user_ids:
+            future = waiting.get(user_id)
+            if future is None:
+                future = waiting[user_id] = loop.create_future()
+            futures[user_id] = future
+
+        # Shielded, so one caller giving up doesn't cancel the lookup for everyone else waiting on it
+        members = await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))
+        return {user_id: member for user_id, member in zip(futures, members) if member is not None}
+
+    def _start_flush(self, guild):
+        task = asyncio.ensure_future(self._flush(guild))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, guild):
+        waiting = self._waiting.pop(guild.id)
+        user_ids = list(waiting)
+        for start in range(0, len(user_ids), QUERY_LIMIT):
+            batch = user_ids[start:start + QUERY_LIMIT]
+            self.requests += 1
+            try:
+                members = await guild.query_members(user_ids=batch, limit=len(batch), cache=False)
+            except Exception as e:
+                self.errors += 1
+                print(f"❌ Error fetching {len(batch)} members of {guild.name}: {str(e)}")
+                members = []
+
+            self.fetched += len(members)
+            found = {member.id: member for member in members}
+            for user_id in batch:
+                member = found.get(user_id)
+                if member is not None:
+                    self.remember(member)
+                waiting[user_id].set_result(member)
+
+    async def members_with_roles(self, guild, roles):
+        """
+        Every member with any of the roles. Without every member cached, this lists the whole
+        guild through the API (1000 members per request) and keeps none of them.
+        """
+        role_ids = {role.id for role in roles}
+        if guild.chunked:
+            return [member for member in guild.members if any(role.id in role_ids for role in member.roles)]
+        return [member async for member in guild.fetch_members(limit=None)
+                if any(role.id in role_ids for role in member.roles)]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self._members),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "requests": self.requests,
+            "fetched": self.fetched,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
+
+
+def _synthetic_state(profile):
+    intents = discord.Intents.default()
+    intents.members = True
+    flags, chunk = cache_options(profile, intents)
+    return discord.state.ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, http=None,
+                                         intents=intents, member_cache_flags=flags, chunk_guilds_at_startup=chunk)
+
+
+def _member_payload(user_id, role_ids):
+    return {
+        "user": {"id": str(user_id), "username": f"member{user_id}", "discriminator": "0",
+                 "global_name": f"Member {user_id}", "avatar": "a" * 32},
+        "roles": role_ids,
+        "joined_at": "2024-01-01T00:00:00.000000+00:00",
+        "deaf": False,
+        "mute": False,
+        "flags": 0,
+    }
+
+
+def simulate(profile, members=100_000, active=20_000, max_members=5000):
+    """
+    Builds one synthetic guild as the profile would cache it after startup plus `active` members
+    seen in events, and returns (members cached, bytes used).
+    """
+    gc.collect()
+    tracemalloc.start()
+    state = _synthetic_state(profile)
+    guild = discord.Guild(data={"id": "1", "name": "synthetic", "member_count": members,
+                                "roles": [{"id": str(i), "name": f"role{i}", "permissions": "0"} for i in range(1, 21)]},
+                          state=state)
+    member_cache = MemberCache(max_members)
+    first_user = 10_000_000
+
+    if state._chunk_guilds:
+        # What the startup chunk requests store
+        for user_id in range(first_user, first_user + members):
+            guild._add_member(discord.Member(data=_member_payload(user_id, [str(user_id % 20 + 1)]), guild=guild, state=state))
+
+    # Members seen in messages, reactions and member updates, spread over the guild
+    for n in range(active):
+        user_id = first_user + (n * 7919) % members
+        member = discord.Member(data=_member_payload(user_id, [str(user_id % 20 + 1)]), guild=guild, state=state)
+        if profile == "lazy":
+            # discord.py keeps members it gets an update for when it caches joins
+            guild._add_member(member)
+        elif profile == "lean":
+            member_cache.remember(member)
+
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(guild._members) + len(member_cache), used
+
+
+def report(members=100_000, active=20_000):
+    print(f"Synthetic guild: {members} members, {active} of them active")
+    for profile in PROFILES:
+        start = time.perf_counter()
+        cached, used = simulate(profile, members, active)
+        print(f"{profile:>5}: {cached:>7} members cached | {used / 1_000_000:7.1f} MB | built in {time.perf_counter() - start:.1f}s")
+
+
+def main(args):
+    if not args or args[0] != "report":
+        print(__doc__)
+        return 1
+    members = int(args[1]) if len(args) > 1 else 100_000
+    active = int(args[2]) if len(args) > 2 else 20_000
+    report(members, active)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
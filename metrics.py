@@ -0,0 +1,197 @@
+"""
+Counters and latency histograms for commands, events, upstream APIs and storage.
+
+Everything is recorded into one Registry on the event loop thread. render() turns it into the
+Prometheus text format, and serve() exposes that on a small Flask endpoint running in a
+background thread. The endpoint asks the event loop to render, so it never reads half-updated state.
+"""
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds (seconds) of the latency buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimates a quantile as the upper bound of the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class UpstreamCall:
+    """Times one call to an outside API; set .status to the HTTP status code once it is known."""
+
+    def __init__(self, registry, service):
+        self.registry = registry
+        self.service = service
+        self.status = None
+
+    async def __aenter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        status = self.status
+        if status is None:
+            # HTTP errors raised by raise_for_status() carry the status code
+            status = getattr(exc, "status", None) or ("error" if exc_type else "ok")
+        self.registry.observe("milo_upstream_seconds", time.perf_counter() - self.start, service=self.service)
+        self.registry.inc("milo_upstream_responses_total", service=self.service, status=status)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.started = time.time()
+        # (name, labels) -> value / Histogram
+        self.counters = {}
+        self.histograms = {}
+        # functions returning [(name, labels dict, value, type)] for values owned by other objects
+        self.collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, _labels(labels)))
+
+    def upstream(self, service):
+        """async with registry.upstream("tenor") as call: ... call.status = response.status"""
+        return UpstreamCall(self, service)
+
+    def timed_event(self, func):
+        """Decorator for event handlers (put it under @bot.event) that records how long each call takes."""
+        name = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.observe("milo_event_seconds", time.perf_counter() - start, event=name)
+
+        return wrapper
+
+    def instrument_storage(self, storage):
+        """Wraps the storage backend's public methods so each call is timed by operation."""
+        for name in dir(storage):
+            method = getattr(storage, name)
+            # Generators return before doing any work, so timing them would mean nothing
+            if name.startswith("_") or not inspect.ismethod(method) or inspect.isgeneratorfunction(method):
+                continue
+            setattr(storage, name, self._timed_call(method, name))
+
+    def _timed_call(self, method, name):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.observe("milo_storage_seconds", time.perf_counter() - start, op=name)
+        return wrapper
+
+    async def monitor_loop_lag(self, interval=1.0):
+        """Measures how late the event loop wakes up from a sleep; anything above a few ms means something blocked it."""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.observe("milo_event_loop_lag_seconds", max(time.perf_counter() - start - interval, 0.0))
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        for collect in self.collectors:
+            for name, labels, value, kind in collect():
+                declare(name, kind)
+                lines.append(f"{name}{_format_labels(_labels(labels))} {value}")
+
+        declare("milo_uptime_seconds", "gauge")
+        lines.append(f"milo_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, loop, host="127.0.0.1", port=9100):
+        """Serves /metrics from a Flask app in a daemon thread."""
+        from flask import Flask, Response
+
+        app = Flask("milo-metrics")
+
+        async def render():
+            return self.render()
+
+        @app.route("/metrics")
+        def metrics():
+            text = asyncio.run_coroutine_threadsafe(render(), loop).result(timeout=5)
+            return Response(text, mimetype="text/plain; version=0.0.4")
+
+        thread = threading.Thread(target=app.run, kwargs={"host": host, "port": port, "use_reloader": False},
+                                  name="metrics", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,148 @@
+"""
+Crash-safe JSON file writes.
+
+Files are written to a temporary file in the same directory, optionally fsynced, and renamed over
+the original, so a crash mid-write leaves either the old or the new file, never a truncated one.
+CoalescingWriter turns bursts of saves to the same file into a single write.
+"""
+import asyncio
+import json
+import os
+import tempfile
+
+# Files bigger than this are written without indentation, even if pretty printing was asked for
+PRETTY_PRINT_LIMIT = 256 * 1024
+
+
+def dumps(data, indent=None):
+    """Serializes data compactly, or indented if `indent` is set and the result is small enough."""
+    text = json.dumps(data, separators=(",", ":"))
+    if indent and len(text) <= PRETTY_PRINT_LIMIT:
+        text = json.dumps(data, indent=indent)
+    return text
+
+
+def atomic_write_json(path, data, indent=None, fsync=True):
+    """Writes JSON to a temporary file next to `path` and renames it over the original."""
+    atomic_write_text(path, dumps(data, indent), fsync)
+
+
+def atomic_write_text(path, text, fsync=True):
+    """Writes text to a temporary file next to `path` and renames it over the original."""
+    directory = os.path.dirname(os.path.abspath(path))
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            file.write(text)
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    # Make the rename itself durable
+    if fsync and hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class CoalescingWriter:
+    """
+    Delays each file's write by `delay` seconds so that every save in between becomes one write.
+
+    Inside the event loop the data is serialized on the loop and written (and fsynced) in a worker
+    thread, so disk latency never blocks the loop. Outside a running event loop (scripts, shutdown)
+    saves are written immediately. Call flush() before exiting to write anything still pending.
+    """
+
+    def __init__(self, delay=1.0, fsync=True):
+        self.delay = delay
+        self.fsync = fsync
+        # path -> (get_data, indent, after_write)
+        self._pending = {}
+        self._timers = {}
+        # path -> future of the write running in a worker thread
+        self._writing = {}
+        self.saves = 0
+        self.writes = 0
+
+    def save(self, path, get_data, indent=None, after_write=None):
+        """Schedules a write of get_data() to path. get_data is called at write time, so the latest data is used."""
+        self.saves += 1
+        self._pending[path] = (get_data, indent, after_write)
+        if path in self._timers:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is None or self.delay <= 0:
+            self.flush(path)
+        else:
+            self._timers[path] = loop.call_later(self.delay, self._write_in_background, path, loop)
+
+    def _write_in_background(self, path, loop):
+        self._timers.pop(path, None)
+        if path in self._writing:
+            # One write per file at a time, so an older write can't land after a newer one
+            self._timers[path] = loop.call_later(self.delay, self._write_in_background, path, loop)
+            return
+
+        entry = self._pending.pop(path, None)
+        if entry is None:
+            return
+
+        # Serialize here: the data may change on the loop as soon as this returns
+        get_data, indent, _ = entry
+        text = dumps(get_data(), indent)
+        future = self._writing[path] = loop.run_in_executor(None, atomic_write_text, path, text, self.fsync)
+        future.add_done_callback(lambda future: self._written(path, entry, future))
+
+    def _written(self, path, entry, future):
+        del self._writing[path]
+        error = future.exception() if not future.cancelled() else OSError("write cancelled")
+        if error is not None:
+            # Keep the save pending (unless a newer one replaced it) so the next flush tries again
+            print(f"❌ Could not write {path}: {error}")
+            self._pending.setdefault(path, entry)
+            return
+
+        self.writes += 1
+        _, _, after_write = entry
+        if after_write:
+            after_write()
+
+    def flush(self, path=None):
+        """Writes pending saves for one path, or for every path if none is given."""
+        for pending_path in [path] if path else list(self._pending):
+            timer = self._timers.pop(pending_path, None)
+            if timer:
+                timer.cancel()
+
+            entry = self._pending.pop(pending_path, None)
+            if entry is None:
+                continue
+
+            get_data, indent, after_write = entry
+            try:
+                atomic_write_json(pending_path, get_data(), indent, self.fsync)
+            except OSError as e:
+                # Keep the save pending so the next flush tries again
+                print(f"❌ Could not write {pending_path}: {e}")
+                self._pending.setdefault(pending_path, entry)
+                continue
+
+            self.writes += 1
+            if after_write:
+                after_write()
@@ -0,0 +1,56 @@
+"""
+Ordered message-processing pipeline used by on_message.
+
+Each stage is an async function that takes the message and returns True to stop the pipeline
+(e.g. the message was fully handled). Stages run in registration order and each one is timed.
+"""
+import time
+
+
+class StageTiming:
+    __slots__ = ("calls", "total", "max")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+
+class MessagePipeline:
+    def __init__(self):
+        # (name, func, timing) in the order the stages run
+        self.stages = []
+
+    def stage(self, name):
+        """Decorator that appends a stage to the pipeline."""
+        def register(func):
+            self.stages.append((name, func, StageTiming()))
+            return func
+        return register
+
+    async def run(self, message):
+        for name, func, timing in self.stages:
+            start = time.perf_counter()
+            try:
+                stop = await func(message)
+            finally:
+                timing.record(time.perf_counter() - start)
+            if stop:
+                return
+
+    def stats(self):
+        """Returns {stage name: {"calls", "avg_ms", "max_ms"}}."""
+        return {
+            name: {
+                "calls": timing.calls,
+                "avg_ms": timing.total / timing.calls * 1000 if timing.calls else 0.0,
+                "max_ms": timing.max * 1000,
+            }
+            for name, _, timing in self.stages
+        }
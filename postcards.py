@@ -0,0 +1,264 @@
+"""
+Postcard mailboxes: sending, opening and expiring postcards, and paging through them in Discord.
+
+Postcards live in the storage backend, one record per postcard. Only the number of postcards
+waiting in each non-empty mailbox is kept here, so memory grows with the number of people who
+have mail, not with how many postcards were ever sent. The "you've got mail" DMs go out through
+DeliveryQueue, which sends them from a few workers in the background.
+"""
+import asyncio
+import random
+import time
+
+import aiohttp
+import discord
+
+from ratelimit import TokenBucket
+
+# Discord allows 4096 characters in an embed description, keep some room for the headings
+PAGE_CHARS = 3900
+
+
+class Mailboxes:
+    def __init__(self, storage, limit=50, max_age=30 * 24 * 3600, shared=False, shared_len_ttl=60):
+        self.storage = storage
+        self.limit = limit
+        self.max_age = max_age
+        # When other processes share the storage they send and open postcards too,
+        # so counts are asked from storage every time instead of being cached
+        self.shared = shared
+        # recipient_id -> number of waiting postcards, loaded on first use
+        self._counts = None
+        # In shared mode, the number of non-empty mailboxes counts every postcard, so it is kept
+        # until this process changes the postcards or shared_len_ttl seconds pass (for the others)
+        self.shared_len_ttl = shared_len_ttl
+        self._shared_len = None
+        self._shared_len_at = 0.0
+        self.sent = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def _mailbox_counts(self):
+        if self._counts is None:
+            self._counts = {str(recipient_id): count for recipient_id, count in self.storage.postcard_counts().items()}
+        return self._counts
+
+    def _counts_for(self, recipient_ids):
+        if self.shared:
+            return {str(recipient_id): count for recipient_id, count in self.storage.postcard_counts(recipient_ids).items()}
+        return self._mailbox_counts()
+
+    def __len__(self):
+        if self.shared:
+            now = time.monotonic()
+            if self._shared_len is None or now - self._shared_len_at >= self.shared_len_ttl:
+                self._shared_len = len(self.storage.postcard_counts())
+                self._shared_len_at = now
+            return self._shared_len
+        return len(self._mailbox_counts())
+
+    def count(self, recipient_id):
+        return self._counts_for([recipient_id]).get(str(recipient_id), 0)
+
+    def send(self, recipient_id, message):
+        """Stores a postcard. Returns False (and stores nothing) if the recipient's mailbox is full."""
+        return bool(self.send_many([recipient_id], message)[0])
+
+    def send_many(self, recipient_ids, message):
+        """Stores the same postcard for several recipients in one write. Returns (stored ids, ids with a full mailbox)."""
+        counts = self._counts_for(recipient_ids)
+        stored, full = [], []
+        for recipient_id in recipient_ids:
+            (full if counts.get(str(recipient_id), 0) >= self.limit else stored).append(recipient_id)
+
+        if stored:
+            self.storage.add_postcards([(recipient_id, message) for recipient_id in stored])
+            self._shared_len = None
+            for recipient_id in stored:
+                counts[str(recipient_id)] = counts.get(str(recipient_id), 0) + 1
+        self.sent += len(stored)
+        self.rejected += len(full)
+        return stored, full
+
+    def open(self, recipient_id):
+        """Returns every postcard waiting for the recipient, oldest first. They stay until remove() is called."""
+        recipient_id = str(recipient_id)
+        if not self.count(recipient_id):
+            return []
+        return self.storage.get_postcards(recipient_id)
+
+    def remove(self, recipient_id, postcards):
+        """Removes postcards returned by open(), once they were shown; ones that arrived since are kept."""
+        recipient_id = str(recipient_id)
+        self.storage.delete_postcards(recipient_id, [postcard["id"] for postcard in postcards])
+        self._shared_len = None
+        if not self.shared:
+            counts = self._mailbox_counts()
+            remaining = counts.get(recipient_id, 0) - len(postcards)
+            if remaining > 0:
+                counts[recipient_id] = remaining
+            else:
+                counts.pop(recipient_id, None)
+
+    def expire(self):
+        """Removes postcards older than max_age. Returns how many were removed."""
+        counts = {} if self.shared else self._mailbox_counts()
+        removed = 0
+        for recipient_id, count in self.storage.expire_postcards(time.time() - self.max_age).items():
+            recipient_id = str(recipient_id)
+            remaining = counts.get(recipient_id, 0) - count
+            if remaining > 0:
+                counts[recipient_id] = remaining
+            else:
+                counts.pop(recipient_id, None)
+            removed += count
+        if removed:
+            self._shared_len = None
+        self.expired += removed
+        return removed
+
+
+def paginate(postcards, page_size=5, page_chars=PAGE_CHARS):
+    """Splits postcards into pages of at most page_size postcards and page_chars characters."""
+    pages = []
+    page, size = [], 0
+    for number, postcard in enumerate(postcards, start=1):
+        entry = f"**Postcard {number}:** {postcard['message']}"[:page_chars]
+        if page and (len(page) == page_size or size + len(entry) + 2 > page_chars):
+            pages.append(page)
+            page, size = [], 0
+        page.append(entry)
+        size += len(entry) + 2
+    if page:
+        pages.append(page)
+    return pages
+
+
+class PostcardPages(discord.ui.View):
+    """Shows opened postcards one page at a time, with buttons only the recipient can use."""
+
+    def __init__(self, owner_id, postcards, page_size=5, timeout=300):
+        super().__init__(timeout=timeout)
+        self.owner_id = owner_id
+        self.pages = paginate(postcards, page_size)
+        self.page = 0
+        self.message = None
+        self._update_buttons()
+
+    def embed(self):
+        embed = discord.Embed(title="🌍 Here are your postcards", description="\n\n".join(self.pages[self.page]))
+        embed.set_footer(text=f"Page {self.page + 1}/{len(self.pages)}")
+        return embed
+
+    def _update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= len(self.pages) - 1
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("❌ These postcards aren't yours!", ephemeral=True)
+            return False
+        return True
+
+    async def _show(self, interaction, page):
+        self.page = page
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self._show(interaction, max(self.page - 1, 0))
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self._show(interaction, min(self.page + 1, len(self.pages) - 1))
+
+    async def on_timeout(self):
+        if self.message is not None:
+            self.previous_page.disabled = self.next_page.disabled = True
+            try:
+                await self.message.edit(view=self)
+            except discord.DiscordException:
+                pass
+
+
+DELIVERED, FORBIDDEN, FAILED = "delivered", "forbidden", "failed"
+
+
+class DeliveryQueue:
+    """
+    Sends DMs from `concurrency` workers, paced by a token bucket.
+
+    Rate limits, 5xx responses and network errors are retried with jittered backoff;
+    users who don't accept DMs from the bot (Forbidden) are reported, not retried.
+    """
+
+    def __init__(self, concurrency=5, rate=5.0, burst=5, max_retries=3):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self._queue = asyncio.Queue()
+        self._workers = []
+        self.counts = {DELIVERED: 0, FORBIDDEN: 0, FAILED: 0}
+        self.retries = 0
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def submit(self, user, text):
+        """Queues a DM and returns a future with its outcome: DELIVERED, FORBIDDEN or FAILED."""
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((user, text, future))
+        return future
+
+    async def deliver_all(self, users, text):
+        """DMs every user and returns {outcome: [users]} once all of them were tried."""
+        outcomes = await asyncio.gather(*(self.submit(user, text) for user in users))
+        report = {DELIVERED: [], FORBIDDEN: [], FAILED: []}
+        for user, outcome in zip(users, outcomes):
+            report[outcome].append(user)
+        return report
+
+    async def _work(self):
+        while True:
+            user, text, future = await self._queue.get()
+            try:
+                outcome = await self._send(user, text)
+            except Exception as e:
+                print(f"❌ Error sending postcard DM to {user}: {str(e)}")
+                outcome = FAILED
+            finally:
+                self._queue.task_done()
+            self.counts[outcome] += 1
+            if not future.done():
+                future.set_result(outcome)
+
+    async def _send(self, user, text):
+        attempt = 0
+        while True:
+            wait = self.bucket.time_until()
+            if wait:
+                await asyncio.sleep(wait)
+            self.bucket.take()
+
+            try:
+                await user.send(text)
+                return DELIVERED
+            except discord.Forbidden:
+                return FORBIDDEN
+            except discord.RateLimited as e:
+                delay = e.retry_after
+            except discord.HTTPException as e:
+                if e.status != 429 and e.status < 500:
+                    raise
+                delay = None
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                delay = None
+
+            if attempt >= self.max_retries:
+                return FAILED
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay if delay is not None else random.uniform(0, 2 ** attempt))
@@ -0,0 +1,91 @@
+"""
+Buffer of ready-to-use results (e.g. random cat image URLs) that is refilled in the background.
+
+Commands take items from memory. Once the buffer drops below `low`, it is refilled up to `high`
+in batches. If the upstream is down, refills back off, and the buffer hands out whatever it
+still has before returning None.
+"""
+import asyncio
+import time
+from collections import deque
+
+
+class PrefetchBuffer:
+    def __init__(self, fetch_batch, low=5, high=20, batch_size=10, wait=5.0, max_backoff=60.0):
+        # fetch_batch(n) -> list of up to n items; may raise when the upstream fails
+        self.fetch_batch = fetch_batch
+        self.low = low
+        self.high = high
+        self.batch_size = batch_size
+        # How long get() waits for a refill when the buffer is empty
+        self.wait = wait
+        self.max_backoff = max_backoff
+
+        self._items = deque()
+        self._refill = None
+        self._failures = 0
+        self._next_attempt = 0.0
+
+        self.served = 0
+        self.empty = 0
+        self.fetched = 0
+        self.errors = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def start(self):
+        """Fills the buffer in the background (call once the event loop is running)."""
+        self._start_refill()
+
+    def _start_refill(self):
+        if self._refill is None or self._refill.done():
+            if time.monotonic() >= self._next_attempt:
+                self._refill = asyncio.ensure_future(self._fill())
+        return self._refill
+
+    async def get(self):
+        """Returns the next item, or None if there is none and the upstream can't provide one in time."""
+        if len(self._items) <= self.low:
+            self._start_refill()
+
+        if not self._items and self._refill is not None and not self._refill.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self._refill), self.wait)
+            except asyncio.TimeoutError:
+                pass
+
+        if not self._items:
+            self.empty += 1
+            return None
+        self.served += 1
+        return self._items.popleft()
+
+    async def _fill(self):
+        while len(self._items) < self.high:
+            try:
+                batch = await self.fetch_batch(min(self.batch_size, self.high - len(self._items)))
+            except Exception as e:
+                # Back off before trying again: 1s, 2s, 4s, ... up to max_backoff
+                self.errors += 1
+                self._failures += 1
+                self._next_attempt = time.monotonic() + min(self.max_backoff, 2 ** (self._failures - 1))
+                print(f"❌ Error prefetching: {str(e)}")
+                return
+            self._failures = 0
+
+            known = set(self._items)
+            new_items = [item for item in batch if item not in known]
+            if not new_items:
+                return
+            self._items.extend(new_items)
+            self.fetched += len(new_items)
+
+    def stats(self):
+        return {
+            "buffered": len(self._items),
+            "served": self.served,
+            "empty": self.empty,
+            "fetched": self.fetched,
+            "errors": self.errors,
+        }
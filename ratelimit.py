@@ -0,0 +1,37 @@
+"""
+Token bucket used to pace calls to rate-limited services.
+"""
+import time
+
+
+class TokenBucket:
+    """Holds up to `capacity` tokens and refills `rate` tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, tokens=1):
+        """Seconds until `tokens` tokens are available (0 if they already are)."""
+        self._refill()
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def take(self, tokens=1):
+        self._refill()
+        self.tokens -= tokens
+
+    def try_take(self, tokens=1):
+        """Takes `tokens` tokens if available and returns whether it did."""
+        if self.time_until(tokens) > 0:
+            return False
+        self.tokens -= tokens
+        return True
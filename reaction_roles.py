@@ -0,0 +1,98 @@
+"""
+Reaction roles: which role a reaction grants, and applying the role changes.
+
+ReactionRoleIndex maps (guild_id, message_id, emoji) to a role id, so reactions on unrelated
+messages are rejected with a single dict lookup. RoleChangeBatcher collects the roles a member
+gains or loses in a short window and applies them with one API call each.
+"""
+import asyncio
+
+import discord
+
+
+class ReactionRoleIndex:
+    def __init__(self):
+        self._roles = {}
+
+    def __len__(self):
+        return len(self._roles)
+
+    def rebuild(self, settings):
+        """Rebuilds the index from the settings of every guild."""
+        self._roles.clear()
+        for guild_id, guild_settings in settings.items():
+            self._add_guild(guild_id, guild_settings)
+
+    def rebuild_guild(self, guild_id, guild_settings):
+        guild_id = str(guild_id)
+        for key in [key for key in self._roles if key[0] == guild_id]:
+            del self._roles[key]
+        self._add_guild(guild_id, guild_settings)
+
+    def _add_guild(self, guild_id, guild_settings):
+        # Stored as {message_id: {emoji: role_id}}. Reaction roles set up before they were tied
+        # to a message are stored as {emoji: role_id} and apply to any message (message_id None).
+        for key, value in guild_settings.get("reaction_roles", {}).items():
+            if isinstance(value, dict):
+                for emoji, role_id in value.items():
+                    self._roles[(str(guild_id), int(key), emoji)] = role_id
+            else:
+                self._roles[(str(guild_id), None, key)] = value
+
+    def lookup(self, guild_id, message_id, emoji):
+        """Returns the role id for a reaction, or None if it isn't a reaction role."""
+        guild_id = str(guild_id)
+        return self._roles.get((guild_id, message_id, emoji)) or self._roles.get((guild_id, None, emoji))
+
+
+class RoleChangeBatcher:
+    """Applies role changes for a member `delay` seconds after the first one, all in one go."""
+
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        # (guild_id, member_id) -> [member, roles to add, roles to remove]
+        self._pending = {}
+        # Running flushes, referenced so they can't be garbage collected mid-flight
+        self._tasks = set()
+        self.batches = 0
+
+    def add(self, member, role):
+        _, to_add, to_remove = self._entry(member)
+        to_remove.discard(role)
+        to_add.add(role)
+
+    def remove(self, member, role):
+        _, to_add, to_remove = self._entry(member)
+        to_add.discard(role)
+        to_remove.add(role)
+
+    def _entry(self, member):
+        key = (member.guild.id, member.id)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = [member, set(), set()]
+            asyncio.get_running_loop().call_later(self.delay, self._start_flush, key)
+        return entry
+
+    def _start_flush(self, key):
+        task = asyncio.ensure_future(self._flush(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, key):
+        member, to_add, to_remove = self._pending.pop(key)
+        self.batches += 1
+
+        # Skip roles the member already has (or doesn't have)
+        to_add = [role for role in to_add if role not in member.roles]
+        to_remove = [role for role in to_remove if role in member.roles]
+
+        try:
+            if to_add:
+                await member.add_roles(*to_add, reason="Reaction role")
+                print(f"✅ Assigned {', '.join(role.name for role in to_add)} to {member.name}")
+            if to_remove:
+                await member.remove_roles(*to_remove, reason="Reaction role")
+                print(f"✅ Removed {', '.join(role.name for role in to_remove)} from {member.name}")
+        except discord.DiscordException as e:
+            print(f"❌ Error updating reaction roles for {member.name}: {str(e)}")
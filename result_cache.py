@@ -0,0 +1,105 @@
+"""
+Caches the full result list of a search (Tenor GIFs, Pixabay images) per query.
+
+;gif and ;image only show one random result, but the APIs return a whole page of them. Keeping
+the page lets later calls for the same query pick from it without asking the API again. Pools
+older than `refresh_after` are still served while a fresh page is fetched in the background;
+after `ttl` they are dropped. The least recently used queries are evicted past `max_queries`.
+"""
+import asyncio
+import random
+import time
+from collections import OrderedDict
+
+from ai_client import SingleFlight
+
+
+def normalize_query(query):
+    """Lowercases and collapses whitespace, so "Cats " and "cats" share a pool."""
+    return " ".join(query.lower().split())
+
+
+class ResultPool:
+    def __init__(self, max_queries=500, ttl=24 * 3600, refresh_after=3600, empty_ttl=300):
+        self.max_queries = max_queries
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        # Searches with no results are remembered for a shorter time
+        self.empty_ttl = empty_ttl
+
+        # query -> (results, fetched_at), least recently used first
+        self._pools = OrderedDict()
+        self._fetches = SingleFlight()
+        self._refreshing = set()
+        # Running background refreshes, referenced so they can't be garbage collected mid-flight
+        self._tasks = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.upstream_calls = 0
+
+    def __len__(self):
+        return len(self._pools)
+
+    async def pick(self, query, fetch):
+        """
+        Returns a random result for the query, or None if there are none. fetch(query) is awaited
+        to get the result list on a miss; it should return None on errors, which aren't cached.
+        """
+        results = await self.results(query, fetch)
+        return random.choice(results) if results else None
+
+    async def results(self, query, fetch):
+        key = normalize_query(query)
+        entry = self._pools.get(key)
+        now = time.monotonic()
+
+        if entry is not None:
+            results, fetched_at = entry
+            age = now - fetched_at
+            if age < (self.ttl if results else self.empty_ttl):
+                self.hits += 1
+                self._pools.move_to_end(key)
+                if results and age >= self.refresh_after and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    task = asyncio.ensure_future(self._refresh(key, fetch))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                return results
+            del self._pools[key]
+
+        self.misses += 1
+        # Concurrent misses for the same query share one upstream call
+        return await self._fetches.do(key, lambda: self._fetch(key, fetch))
+
+    async def _fetch(self, key, fetch):
+        self.upstream_calls += 1
+        results = await fetch(key)
+        if results is not None:
+            self._pools[key] = (list(results), time.monotonic())
+            self._pools.move_to_end(key)
+            while len(self._pools) > self.max_queries:
+                self._pools.popitem(last=False)
+        return results
+
+    async def _refresh(self, key, fetch):
+        try:
+            self.refreshes += 1
+            await self._fetch(key, fetch)
+        except Exception as e:
+            # Keep serving the old pool until it expires
+            print(f"❌ Error refreshing results for '{key}': {str(e)}")
+        finally:
+            self._refreshing.discard(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "queries": len(self._pools),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "refreshes": self.refreshes,
+            "upstream_calls": self.upstream_calls,
+        }
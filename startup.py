@@ -0,0 +1,37 @@
+"""
+Timing for bot startup: how long imports, loading data and connecting to Discord take, and how
+long each data store took when it was loaded later on first use.
+"""
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    def __init__(self, began):
+        # began: time.perf_counter() taken before the heavy imports
+        self.began = began
+        self._last = began
+        self.phases = {}
+        self.loads = {}
+        self.done = False
+
+    def mark(self, phase):
+        """Ends a phase that started where the previous one ended."""
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    @contextmanager
+    def loading(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.loads[name] = time.perf_counter() - start
+
+    def report(self):
+        total = sum(self.phases.values())
+        lines = [f"⏱️ Started in {total:.2f}s: " + " | ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items())]
+        if self.loads:
+            lines.append("   Loaded on first use: " + " | ".join(f"{name} {seconds:.2f}s" for name, seconds in self.loads.items()))
+        return "\n".join(lines)
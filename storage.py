@@ -0,0 +1,784 @@
+"""
+Storage backends for Milo's persistent data (currency, XP, settings, postcards and the AI cache).
+
+Both backends expose the same methods, so main.py does not care where the data lives:
+- JsonBackend keeps the original flat JSON files and is fine for small deployments.
+- SqliteBackend stores one row per account/user/guild in a WAL-mode database, so a
+  write only touches the row that changed. Every read-modify-write runs in an IMMEDIATE
+  transaction, so several bot processes (see cluster.py) can share one database.
+
+Run `python storage.py migrate [database]` once to copy the JSON files into SQLite.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from persistence import CoalescingWriter, atomic_write_text
+
+CURRENCY_FILE = "currency.json"
+USER_DATA_FILE = "user_data.json"
+SETTINGS_FILE = "Settings.json"
+POSTCARD_FILE = "postcards.json"
+POSTCARD_LOG_FILE = "postcards.jsonl"
+CACHE_FILE = "ai_cache.json"
+TRANSACTIONS_FILE = "transactions.jsonl"
+DATABASE_FILE = "milo.db"
+
+
+async def run_write(storage, write, *args):
+    """
+    Calls write(*args), a method of the storage backend, from a worker thread if the backend's
+    writes can wait on other processes (threaded_writes), so they never stall the event loop.
+    """
+    if storage.threaded_writes:
+        return await asyncio.get_running_loop().run_in_executor(None, write, *args)
+    return write(*args)
+
+
+def normalize_account(value):
+    """Turns a stored currency entry (old int balance or dict) into {"miles", "last_flight"}."""
+    if isinstance(value, dict):
+        return {"miles": int(value.get("miles", 0)), "last_flight": float(value.get("last_flight", 0))}
+    return {"miles": int(value or 0), "last_flight": 0.0}
+
+
+class JsonBackend:
+    """
+    Keeps every subsystem in its own JSON file. Files are replaced atomically, and changes made
+    within `write_delay` seconds of each other are written together.
+    """
+
+    name = "json"
+    # Writes only touch memory (files are written in the background), so callers needn't use a thread
+    threaded_writes = False
+
+    # file name and indent used when writing each document
+    FILES = {
+        "currency": (CURRENCY_FILE, 4),
+        "xp": (USER_DATA_FILE, 4),
+        "settings": (SETTINGS_FILE, 4),
+        "postcards": (POSTCARD_FILE, None),
+        "ai_cache": (CACHE_FILE, None),
+    }
+
+    def __init__(self, write_delay=1.0, fsync=True):
+        self._docs = {}
+        self._settings_mtime = None
+        # Called with the new settings_version() once a settings write reached the disk
+        self.settings_listeners = []
+        self.writer = CoalescingWriter(write_delay, fsync)
+        self._transactions_file = None
+        # recipient_id -> {postcard_id: postcard}, replayed from the postcard log on first use
+        self._postcards = None
+        self._postcards_file = None
+        self._postcard_lines = 0
+        self._next_postcard_id = 1
+
+    def _read(self, name):
+        path, _ = self.FILES[name]
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def _doc(self, name):
+        if name not in self._docs:
+            self._docs[name] = self._read(name)
+        return self._docs[name]
+
+    def _save(self, name):
+        path, indent = self.FILES[name]
+        after_write = self._settings_written if name == "settings" else None
+        self.writer.save(path, lambda: self._docs[name], indent, after_write)
+
+    def _settings_written(self):
+        self._settings_mtime = self.settings_version()
+        for listener in self.settings_listeners:
+            listener(self._settings_mtime)
+
+    # Currency
+    def load_currency(self):
+        return {
+            guild_id: {user_id: normalize_account(value) for user_id, value in accounts.items()}
+            for guild_id, accounts in self._doc("currency").items()
+        }
+
+    def load_guild_accounts(self, guild_id):
+        return {user_id: normalize_account(value) for user_id, value in self._doc("currency").get(str(guild_id), {}).items()}
+
+    def get_account(self, guild_id, user_id):
+        value = self._doc("currency").get(str(guild_id), {}).get(str(user_id))
+        return None if value is None else normalize_account(value)
+
+    def put_accounts(self, rows):
+        """Stores several (guild_id, user_id, account) rows with a single write."""
+        data = self._doc("currency")
+        for guild_id, user_id, account in rows:
+            data.setdefault(str(guild_id), {})[str(user_id)] = normalize_account(account)
+        self._save("currency")
+
+    def put_account(self, guild_id, user_id, account):
+        self.put_accounts([(guild_id, user_id, account)])
+
+    def update_accounts(self, guild_id, user_ids, change):
+        """
+        Applies change(accounts) to the given accounts in one step. change() edits the
+        {user_id: account} dict in place and returns the transaction records to log,
+        or None to leave everything untouched. Returns whether the change was applied.
+        """
+        guild = self._doc("currency").get(str(guild_id), {})
+        accounts = {str(user_id): normalize_account(guild.get(str(user_id), 0)) for user_id in user_ids}
+        records = change(accounts)
+        if records is None:
+            return False
+
+        # Log first, so balances can always be rebuilt from the log
+        self.append_transactions(records)
+        self._doc("currency").setdefault(str(guild_id), {}).update(accounts)
+        self._save("currency")
+        return True
+
+    # Transaction log (append-only JSON lines)
+    def append_transactions(self, records):
+        if self._transactions_file is None:
+            self._transactions_file = open(TRANSACTIONS_FILE, "a", encoding="utf-8")
+        self._transactions_file.write("".join(json.dumps(record) + "\n" for record in records))
+        self._transactions_file.flush()
+        # Balances are rebuilt from the log, so it must reach the disk before they change
+        if self.writer.fsync:
+            os.fsync(self._transactions_file.fileno())
+
+    def has_transactions(self):
+        return os.path.exists(TRANSACTIONS_FILE) and os.path.getsize(TRANSACTIONS_FILE) > 0
+
+    def start_transaction_log(self, make_records):
+        """Logs make_records() if the transaction log is empty. Returns whether it did."""
+        if self.has_transactions():
+            return False
+        records = make_records()
+        if records:
+            self.append_transactions(records)
+        return True
+
+    def load_transactions(self):
+        """Yields logged transaction records, oldest first."""
+        if not os.path.exists(TRANSACTIONS_FILE):
+            return
+        with open(TRANSACTIONS_FILE, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+    # XP
+    def load_xp(self):
+        # A copy, so XP added in memory isn't in the stored document before update_xp() applies it
+        return {user_id: dict(user_data) for user_id, user_data in self._doc("xp").items()}
+
+    def put_xp(self, rows):
+        """Stores the given {user_id: {"xp", "level"}} entries."""
+        data = self._doc("xp")
+        for user_id, user_data in rows.items():
+            data[str(user_id)] = dict(user_data)
+        self._save("xp")
+
+    def update_xp(self, user_ids, change):
+        """
+        Applies change(rows) to the stored {user_id: {"xp", "level"}} entries of the given users
+        (new users start at level 1) in one step, and returns the updated entries.
+        """
+        data = self._doc("xp")
+        rows = {str(user_id): dict(data.get(str(user_id), {"xp": 0, "level": 1})) for user_id in user_ids}
+        change(rows)
+        data.update(rows)
+        self._save("xp")
+        # Copies, so the caller's in-memory XP never is the stored document (see load_xp)
+        return {user_id: dict(user_data) for user_id, user_data in rows.items()}
+
+    # Settings
+    def settings_version(self):
+        """Changes whenever Settings.json is modified; used to invalidate the settings cache."""
+        try:
+            return os.stat(SETTINGS_FILE).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load_settings(self):
+        """Rereads Settings.json if it changed. Raises json.JSONDecodeError if the file is malformed."""
+        if "settings" not in self._docs or self.settings_version() != self._settings_mtime:
+            self._docs["settings"] = self._read("settings")
+            self._settings_mtime = self.settings_version()
+        return self._docs["settings"]
+
+    def put_guild_settings(self, guild_id, guild_settings):
+        self.load_settings()[str(guild_id)] = guild_settings
+        self._save("settings")
+
+    # Postcards (append-only JSON lines: one line per sent postcard or per batch of removed ones)
+    def _mailboxes(self):
+        if self._postcards is None:
+            self._postcards = {}
+            if os.path.exists(POSTCARD_LOG_FILE):
+                with open(POSTCARD_LOG_FILE, "r", encoding="utf-8") as file:
+                    for line in file:
+                        if line.strip():
+                            self._replay_postcard(json.loads(line))
+                            self._postcard_lines += 1
+            else:
+                # First run with the log: bring over postcards.json from older versions
+                now = time.time()
+                for recipient_id, messages in self._read("postcards").items():
+                    for message in messages:
+                        self.add_postcard(recipient_id, message, now)
+        return self._postcards
+
+    def _replay_postcard(self, entry):
+        mailbox = self._postcards.setdefault(entry["to"], {})
+        if "removed" in entry:
+            for postcard_id in entry["removed"]:
+                mailbox.pop(postcard_id, None)
+        else:
+            mailbox[entry["id"]] = {"id": entry["id"], "message": entry["message"], "created_at": entry["created_at"]}
+            self._next_postcard_id = max(self._next_postcard_id, entry["id"] + 1)
+        if not mailbox:
+            del self._postcards[entry["to"]]
+
+    def _append_postcard_lines(self, entries):
+        if self._postcards_file is None:
+            self._postcards_file = open(POSTCARD_LOG_FILE, "a", encoding="utf-8")
+        self._postcards_file.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        self._postcards_file.flush()
+        # On disk before any "you've got mail" DM goes out
+        if self.writer.fsync:
+            os.fsync(self._postcards_file.fileno())
+        self._postcard_lines += len(entries)
+
+    def _compact_postcards(self):
+        """Rewrites the log with only the postcards still waiting, once most of its lines are history."""
+        live = sum(len(mailbox) for mailbox in self._postcards.values())
+        if self._postcard_lines < 1000 or self._postcard_lines < 2 * live:
+            return
+        if self._postcards_file is not None:
+            self._postcards_file.close()
+            self._postcards_file = None
+        lines = [
+            json.dumps({"to": recipient_id, **postcard}) + "\n"
+            for recipient_id, mailbox in self._postcards.items()
+            for postcard in mailbox.values()
+        ]
+        atomic_write_text(POSTCARD_LOG_FILE, "".join(lines), self.writer.fsync)
+        self._postcard_lines = len(lines)
+
+    def postcard_counts(self, recipient_ids=None):
+        """Returns {recipient_id: number of postcards} for every non-empty mailbox, or only the given ones."""
+        mailboxes = self._mailboxes()
+        if recipient_ids is not None:
+            return {str(r): len(mailboxes[str(r)]) for r in recipient_ids if str(r) in mailboxes}
+        return {recipient_id: len(mailbox) for recipient_id, mailbox in mailboxes.items()}
+
+    def add_postcard(self, recipient_id, message, created_at=None):
+        """Stores a postcard and returns its id."""
+        return self.add_postcards([(recipient_id, message)], created_at)[0]
+
+    def add_postcards(self, rows, created_at=None):
+        """Stores several (recipient_id, message) postcards with a single write and returns their ids."""
+        self._mailboxes()  # load the log first, so the next id is known
+        created_at = created_at or time.time()
+        entries = []
+        for recipient_id, message in rows:
+            entry = {"to": str(recipient_id), "id": self._next_postcard_id, "message": message, "created_at": created_at}
+            self._next_postcard_id += 1
+            entries.append(entry)
+        self._append_postcard_lines(entries)
+        for entry in entries:
+            self._replay_postcard(entry)
+        return [entry["id"] for entry in entries]
+
+    def get_postcards(self, recipient_id, offset=0, limit=None):
+        """Returns a recipient's postcards ({"id", "message", "created_at"}), oldest first."""
+        postcards = list(self._mailboxes().get(str(recipient_id), {}).values())
+        end = None if limit is None else offset + limit
+        return [dict(postcard) for postcard in postcards[offset:end]]
+
+    def delete_postcards(self, recipient_id, postcard_ids):
+        recipient_id = str(recipient_id)
+        mailbox = self._mailboxes().get(recipient_id, {})
+        removed = [postcard_id for postcard_id in postcard_ids if postcard_id in mailbox]
+        if removed:
+            entry = {"to": recipient_id, "removed": removed}
+            self._append_postcard_lines([entry])
+            self._replay_postcard(entry)
+            self._compact_postcards()
+
+    def clear_postcards(self, recipient_id):
+        self.delete_postcards(recipient_id, list(self._mailboxes().get(str(recipient_id), {})))
+
+    def expire_postcards(self, before):
+        """Removes postcards sent before the given time. Returns {recipient_id: number removed}."""
+        expired = {}
+        entries = []
+        for recipient_id, mailbox in self._mailboxes().items():
+            removed = [postcard_id for postcard_id, postcard in mailbox.items() if postcard["created_at"] < before]
+            if removed:
+                expired[recipient_id] = len(removed)
+                entries.append({"to": recipient_id, "removed": removed})
+        if entries:
+            self._append_postcard_lines(entries)
+            for entry in entries:
+                self._replay_postcard(entry)
+            self._compact_postcards()
+        return expired
+
+    def load_postcards(self):
+        """Returns {recipient_id: [postcard, ...]} for every mailbox."""
+        return {recipient_id: self.get_postcards(recipient_id) for recipient_id in self._mailboxes()}
+
+    # AI response cache
+    def load_ai_cache(self):
+        """Returns {key: {"response", "created_at"}}; entries from the old {key: response} format count as new."""
+        now = time.time()
+        return {
+            key: value if isinstance(value, dict) else {"response": value, "created_at": now}
+            for key, value in self._doc("ai_cache").items()
+        }
+
+    def put_ai_responses(self, rows):
+        self._doc("ai_cache").update(rows)
+        self._save("ai_cache")
+
+    def delete_ai_responses(self, keys):
+        data = self._doc("ai_cache")
+        for key in keys:
+            data.pop(key, None)
+        self._save("ai_cache")
+
+    def close(self):
+        self.writer.flush()
+        if self._transactions_file is not None:
+            self._transactions_file.close()
+            self._transactions_file = None
+        if self._postcards_file is not None:
+            self._postcards_file.close()
+            self._postcards_file = None
+
+    # Shard health (only this process can report, so it stays in memory)
+    def put_shard_health(self, rows):
+        self._docs.setdefault("shard_health", {}).update({row["shard_id"]: row for row in rows})
+
+    def load_shard_health(self):
+        return sorted(self._docs.get("shard_health", {}).values(), key=lambda row: row["shard_id"])
+
+
+class SqliteBackend:
+    """Stores each subsystem in its own indexed SQLite table, updating single rows in place."""
+
+    name = "sqlite"
+    # Writes can wait up to busy_timeout for another process, so callers on the event loop should
+    # run them in a worker thread (each thread gets its own connection, see _conn())
+    threaded_writes = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS currency (
+            guild_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            miles INTEGER NOT NULL DEFAULT 0,
+            last_flight REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            time REAL NOT NULL,
+            guild_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            counterparty TEXT,
+            last_flight REAL
+        );
+        CREATE INDEX IF NOT EXISTS transactions_by_account ON transactions (guild_id, user_id);
+        CREATE TABLE IF NOT EXISTS user_xp (
+            user_id TEXT PRIMARY KEY,
+            xp INTEGER NOT NULL,
+            level INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS settings (
+            guild_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS settings_version (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            version INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO settings_version (id, version) VALUES (0, 0);
+        CREATE TABLE IF NOT EXISTS postcards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient_id TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS postcards_by_recipient ON postcards (recipient_id, id);
+        CREATE INDEX IF NOT EXISTS postcards_by_age ON postcards (created_at);
+        CREATE TABLE IF NOT EXISTS ai_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS shard_health (
+            shard_id INTEGER PRIMARY KEY,
+            cluster_id INTEGER NOT NULL,
+            pid INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            guilds INTEGER NOT NULL,
+            latency REAL,
+            updated_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path=DATABASE_FILE):
+        self.path = path
+        # Called with the new settings_version() after each settings write
+        self.settings_listeners = []
+        self.conn = self._connect()
+        self.conn.executescript(self.SCHEMA)
+        # Connections of worker threads, so their transactions never mix with the event loop's
+        self._local = threading.local()
+        self._thread_conns = []
+
+    def _connect(self):
+        # Not pinned to one thread: close() may run after the loop thread is done with it
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _conn(self):
+        """The connection for the calling thread."""
+        if threading.current_thread() is threading.main_thread():
+            return self.conn
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._thread_conns.append(conn)
+        return conn
+
+    def _write(self, sql, rows):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(sql, rows)
+
+    # Currency
+    def load_currency(self):
+        data = {}
+        for guild_id, user_id, miles, last_flight in self.conn.execute(
+                "SELECT guild_id, user_id, miles, last_flight FROM currency"):
+            data.setdefault(guild_id, {})[user_id] = {"miles": miles, "last_flight": last_flight}
+        return data
+
+    def load_guild_accounts(self, guild_id):
+        return {
+            user_id: {"miles": miles, "last_flight": last_flight}
+            for user_id, miles, last_flight in self.conn.execute(
+                "SELECT user_id, miles, last_flight FROM currency WHERE guild_id = ?", (str(guild_id),))
+        }
+
+    def get_account(self, guild_id, user_id):
+        row = self.conn.execute(
+            "SELECT miles, last_flight FROM currency WHERE guild_id = ? AND user_id = ?",
+            (str(guild_id), str(user_id))).fetchone()
+        return None if row is None else {"miles": row[0], "last_flight": row[1]}
+
+    def put_accounts(self, rows):
+        """Stores several (guild_id, user_id, account) rows in one transaction."""
+        params = []
+        for guild_id, user_id, account in rows:
+            account = normalize_account(account)
+            params.append((str(guild_id), str(user_id), account["miles"], account["last_flight"]))
+        self._write(
+            "INSERT INTO currency (guild_id, user_id, miles, last_flight) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (guild_id, user_id) DO UPDATE SET miles = excluded.miles, last_flight = excluded.last_flight",
+            params)
+
+    def put_account(self, guild_id, user_id, account):
+        self.put_accounts([(guild_id, user_id, account)])
+
+    def update_accounts(self, guild_id, user_ids, change):
+        """
+        Applies change(accounts) to the given accounts inside one IMMEDIATE transaction, so
+        concurrent writers (even in other processes) can't interleave. See JsonBackend.update_accounts.
+        """
+        guild_id = str(guild_id)
+        user_ids = [str(user_id) for user_id in user_ids]
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            accounts = {user_id: {"miles": 0, "last_flight": 0.0} for user_id in user_ids}
+            placeholders = ", ".join("?" * len(user_ids))
+            for user_id, miles, last_flight in conn.execute(
+                    f"SELECT user_id, miles, last_flight FROM currency WHERE guild_id = ? AND user_id IN ({placeholders})",
+                    (guild_id, *user_ids)):
+                accounts[user_id] = {"miles": miles, "last_flight": last_flight}
+
+            records = change(accounts)
+            if records is None:
+                return False
+
+            conn.executemany(
+                "INSERT INTO currency (guild_id, user_id, miles, last_flight) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (guild_id, user_id) DO UPDATE SET miles = excluded.miles, last_flight = excluded.last_flight",
+                [(guild_id, user_id, account["miles"], account["last_flight"]) for user_id, account in accounts.items()])
+            self._insert_transactions(records, conn)
+        return True
+
+    # Transaction log
+    def _insert_transactions(self, records, conn=None):
+        (conn or self.conn).executemany(
+            "INSERT INTO transactions (time, guild_id, user_id, delta, kind, counterparty, last_flight) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(r["time"], r["guild_id"], r["user_id"], r["delta"], r["kind"], r.get("counterparty"), r.get("last_flight"))
+             for r in records])
+
+    def append_transactions(self, records):
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._insert_transactions(records)
+
+    def has_transactions(self):
+        return self.conn.execute("SELECT 1 FROM transactions LIMIT 1").fetchone() is not None
+
+    def start_transaction_log(self, make_records):
+        """
+        Logs make_records() if the transaction log is empty. The check and the insert share one
+        transaction, so processes starting at the same time can't both log opening balances.
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if self.has_transactions():
+                return False
+            self._insert_transactions(make_records())
+        return True
+
+    def load_transactions(self):
+        columns = ("time", "guild_id", "user_id", "delta", "kind", "counterparty", "last_flight")
+        for row in self.conn.execute(f"SELECT {', '.join(columns)} FROM transactions ORDER BY id"):
+            yield {key: value for key, value in zip(columns, row) if value is not None}
+
+    # XP
+    def load_xp(self):
+        return {
+            user_id: {"xp": xp, "level": level}
+            for user_id, xp, level in self.conn.execute("SELECT user_id, xp, level FROM user_xp")
+        }
+
+    def put_xp(self, rows):
+        self._write(
+            "INSERT INTO user_xp (user_id, xp, level) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET xp = excluded.xp, level = excluded.level",
+            [(str(user_id), data["xp"], data["level"]) for user_id, data in rows.items()])
+
+    def update_xp(self, user_ids, change):
+        """See JsonBackend.update_xp. Runs in one IMMEDIATE transaction, so XP earned in other processes isn't overwritten."""
+        user_ids = [str(user_id) for user_id in user_ids]
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = {user_id: {"xp": 0, "level": 1} for user_id in user_ids}
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                for user_id, xp, level in conn.execute(
+                        f"SELECT user_id, xp, level FROM user_xp WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk):
+                    rows[user_id] = {"xp": xp, "level": level}
+
+            change(rows)
+            conn.executemany(
+                "INSERT INTO user_xp (user_id, xp, level) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET xp = excluded.xp, level = excluded.level",
+                [(user_id, data["xp"], data["level"]) for user_id, data in rows.items()])
+        return rows
+
+    # Settings
+    def settings_version(self):
+        """A counter bumped by every settings write, from any process (other tables don't change it)."""
+        return self.conn.execute("SELECT version FROM settings_version").fetchone()[0]
+
+    def load_settings(self):
+        return {guild_id: json.loads(data) for guild_id, data in self.conn.execute("SELECT guild_id, data FROM settings")}
+
+    def put_guild_settings(self, guild_id, guild_settings):
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(
+                "INSERT INTO settings (guild_id, data) VALUES (?, ?) "
+                "ON CONFLICT (guild_id) DO UPDATE SET data = excluded.data",
+                (str(guild_id), json.dumps(guild_settings)))
+            self.conn.execute("UPDATE settings_version SET version = version + 1")
+            version = self.settings_version()
+        for listener in self.settings_listeners:
+            listener(version)
+
+    # Postcards
+    def postcard_counts(self, recipient_ids=None):
+        if recipient_ids is None:
+            return dict(self.conn.execute("SELECT recipient_id, COUNT(*) FROM postcards GROUP BY recipient_id"))
+        recipient_ids = [str(recipient_id) for recipient_id in recipient_ids]
+        counts = {}
+        for start in range(0, len(recipient_ids), 500):
+            chunk = recipient_ids[start:start + 500]
+            counts.update(self.conn.execute(
+                f"SELECT recipient_id, COUNT(*) FROM postcards WHERE recipient_id IN ({', '.join('?' * len(chunk))}) "
+                "GROUP BY recipient_id", chunk))
+        return counts
+
+    def add_postcard(self, recipient_id, message, created_at=None):
+        return self.add_postcards([(recipient_id, message)], created_at)[0]
+
+    def add_postcards(self, rows, created_at=None):
+        """Stores several (recipient_id, message) postcards in one transaction and returns their ids."""
+        created_at = created_at or time.time()
+        ids = []
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for recipient_id, message in rows:
+                cursor = self.conn.execute(
+                    "INSERT INTO postcards (recipient_id, message, created_at) VALUES (?, ?, ?)",
+                    (str(recipient_id), message, created_at))
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def get_postcards(self, recipient_id, offset=0, limit=None):
+        return [
+            {"id": postcard_id, "message": message, "created_at": created_at}
+            for postcard_id, message, created_at in self.conn.execute(
+                "SELECT id, message, created_at FROM postcards WHERE recipient_id = ? ORDER BY id LIMIT ? OFFSET ?",
+                (str(recipient_id), -1 if limit is None else limit, offset))
+        ]
+
+    def delete_postcards(self, recipient_id, postcard_ids):
+        self._write("DELETE FROM postcards WHERE recipient_id = ? AND id = ?",
+                    [(str(recipient_id), postcard_id) for postcard_id in postcard_ids])
+
+    def clear_postcards(self, recipient_id):
+        self._write("DELETE FROM postcards WHERE recipient_id = ?", [(str(recipient_id),)])
+
+    def expire_postcards(self, before):
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            expired = dict(self.conn.execute(
+                "SELECT recipient_id, COUNT(*) FROM postcards WHERE created_at < ? GROUP BY recipient_id", (before,)))
+            self.conn.execute("DELETE FROM postcards WHERE created_at < ?", (before,))
+        return expired
+
+    def load_postcards(self):
+        data = {}
+        for postcard_id, recipient_id, message, created_at in self.conn.execute(
+                "SELECT id, recipient_id, message, created_at FROM postcards ORDER BY id"):
+            data.setdefault(recipient_id, []).append({"id": postcard_id, "message": message, "created_at": created_at})
+        return data
+
+    # AI response cache
+    def load_ai_cache(self):
+        return {
+            key: {"response": response, "created_at": created_at}
+            for key, response, created_at in self.conn.execute("SELECT key, response, created_at FROM ai_cache")
+        }
+
+    def put_ai_responses(self, rows):
+        self._write(
+            "INSERT INTO ai_cache (key, response, created_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET response = excluded.response, created_at = excluded.created_at",
+            [(key, row["response"], row["created_at"]) for key, row in rows.items()])
+
+    def delete_ai_responses(self, keys):
+        self._write("DELETE FROM ai_cache WHERE key = ?", [(key,) for key in keys])
+
+    # Shard health, written by every bot process sharing the database
+    def put_shard_health(self, rows):
+        self._write(
+            "INSERT INTO shard_health (shard_id, cluster_id, pid, status, guilds, latency, updated_at) "
+            "VALUES (:shard_id, :cluster_id, :pid, :status, :guilds, :latency, :updated_at) "
+            "ON CONFLICT (shard_id) DO UPDATE SET cluster_id = excluded.cluster_id, pid = excluded.pid, "
+            "status = excluded.status, guilds = excluded.guilds, latency = excluded.latency, updated_at = excluded.updated_at",
+            rows)
+
+    def load_shard_health(self):
+        columns = ("shard_id", "cluster_id", "pid", "status", "guilds", "latency", "updated_at")
+        return [dict(zip(columns, row)) for row in self.conn.execute(
+            f"SELECT {', '.join(columns)} FROM shard_health ORDER BY shard_id")]
+
+    def close(self):
+        for conn in self._thread_conns:
+            conn.close()
+        self.conn.close()
+
+
+def get_storage():
+    """Returns the backend selected by the STORAGE_BACKEND environment variable (default: json)."""
+    backend = os.getenv("STORAGE_BACKEND", "json").lower()
+    if backend == "sqlite":
+        return SqliteBackend(os.getenv("STORAGE_DB", DATABASE_FILE))
+    if backend == "json":
+        return JsonBackend(float(os.getenv("JSON_WRITE_DELAY", "1.0")), os.getenv("JSON_FSYNC", "1") != "0")
+    raise ValueError(f"Unknown STORAGE_BACKEND '{backend}', expected 'json' or 'sqlite'.")
+
+
+def migrate_json_to_sqlite(source, target):
+    """Copies everything from a JsonBackend into a SqliteBackend. Safe to run more than once."""
+    currency = source.load_currency()
+    target.put_accounts(
+        (guild_id, user_id, account)
+        for guild_id, accounts in currency.items()
+        for user_id, account in accounts.items())
+
+    # The transaction log is appended to, so only copy it into an empty database
+    transactions = 0
+    if not target.has_transactions():
+        records = list(source.load_transactions())
+        if records:
+            target.append_transactions(records)
+        transactions = len(records)
+
+    xp = source.load_xp()
+    target.put_xp(xp)
+
+    settings = source.load_settings()
+    for guild_id, guild_settings in settings.items():
+        target.put_guild_settings(guild_id, guild_settings)
+
+    # Postcards are appended, so replace each mailbox instead of duplicating it
+    postcards = source.load_postcards()
+    for recipient_id, messages in postcards.items():
+        target.clear_postcards(recipient_id)
+        for postcard in messages:
+            target.add_postcard(recipient_id, postcard["message"], postcard["created_at"])
+
+    ai_cache = source.load_ai_cache()
+    target.put_ai_responses(ai_cache)
+
+    return {
+        "accounts": sum(len(accounts) for accounts in currency.values()),
+        "transactions": transactions,
+        "users": len(xp),
+        "guild settings": len(settings),
+        "postcards": sum(len(messages) for messages in postcards.values()),
+        "cached AI responses": len(ai_cache),
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("Usage: python storage.py migrate [database]")
+        sys.exit(1)
+
+    database = sys.argv[2] if len(sys.argv) > 2 else DATABASE_FILE
+    target = SqliteBackend(database)
+    counts = migrate_json_to_sqlite(JsonBackend(), target)
+    target.close()
+
+    print(f"✅ Migrated JSON data into {database}:")
+    for label, count in counts.items():
+        print(f"   {count} {label}")
@@ -0,0 +1,78 @@
+"""
+Shows text in Discord while it is still being generated.
+"""
+import time
+
+import discord
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Splits text into chunks that fit in a Discord message, preferring to break at newlines."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class StreamingReply:
+    """
+    Posts a message as soon as the first text arrives, then edits it as more text comes in.
+
+    Edits are throttled to one per `interval` seconds to stay well inside Discord's edit rate limit,
+    and the live message never goes past Discord's 2000 character limit.
+    """
+
+    def __init__(self, channel, interval=1.0):
+        self.channel = channel
+        self.interval = interval
+        self.message = None
+        self._shown = ""
+        self._last_edit = 0.0
+        self._failed = False
+
+    async def update(self, text):
+        """Called with the full text so far; sends or edits the message if enough time has passed."""
+        if self._failed:
+            return
+
+        text = text[:DISCORD_MESSAGE_LIMIT]
+        if not text.strip() or text == self._shown:
+            return
+        if self.message and time.monotonic() - self._last_edit < self.interval:
+            return
+
+        try:
+            if self.message is None:
+                self.message = await self.channel.send(text)
+            else:
+                await self.message.edit(content=text)
+        except discord.HTTPException as e:
+            # Stop live updates (e.g. the message was deleted); finish() still sends the result
+            print(f"❌ Could not update streaming reply: {e}")
+            self._failed = True
+            return
+
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+    async def finish(self, text):
+        """Shows the complete text, splitting it over extra messages if it is too long for one."""
+        chunks = split_message(text) or [text]
+        first, rest = chunks[0], chunks[1:]
+
+        if self.message is not None and not self._failed:
+            if first != self._shown:
+                await self.message.edit(content=first)
+        else:
+            await self.channel.send(first)
+
+        for chunk in rest:
+            await self.channel.send(chunk)
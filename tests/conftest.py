@@ -0,0 +1,12 @@
+import pytest
+
+from storage import JsonBackend, SqliteBackend
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, tmp_path, monkeypatch):
+    # The JSON backend uses file names relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    storage = JsonBackend() if request.param == "json" else SqliteBackend(str(tmp_path / "milo.db"))
+    yield storage
+    storage.close()
@@ -0,0 +1,60 @@
+import time
+
+from ai_cache import AICache, make_key, prompt_scope
+
+
+def test_keys_ignore_case_whitespace_and_edge_punctuation():
+    assert make_key("Hi there!") == make_key("  hi   THERE ") == "global:hi there"
+    assert make_key("what is 2+2?") != make_key("what is 22?")
+    assert make_key("C++") != make_key("C")
+
+
+def test_keys_are_scoped_by_guild_prompt():
+    scope = prompt_scope(1, "You are a pirate.")
+    assert make_key("hi", scope) != make_key("hi")
+    assert make_key("hi", scope) != make_key("hi", prompt_scope(2, "You are a pirate."))
+    assert make_key("hi", scope) != make_key("hi", prompt_scope(1, "You are a robot."))
+
+
+def test_least_recently_used_is_evicted_past_max_entries():
+    cache = AICache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
+    assert cache.evictions == 1
+
+
+def test_evicted_past_max_bytes():
+    cache = AICache(max_bytes=25)
+    cache.put("a", "x" * 10)
+    cache.put("b", "y" * 10)
+    cache.put("c", "z" * 10)
+    assert len(cache) == 2
+    assert cache.stats()["bytes"] <= 25
+    assert cache.get("a") is None
+
+
+def test_expired_entries_are_misses():
+    cache = AICache(ttl=60)
+    cache.load({"global:old": {"response": "stale", "created_at": time.time() - 120}})
+    assert len(cache) == 0
+    cache.put("global:new", "fresh")
+    cache._entries["global:new"] = ("fresh", time.time() - 120)
+    assert cache.get("global:new") is None
+    assert cache.expirations == 1
+
+
+def test_pending_changes_are_taken_once():
+    cache = AICache(max_entries=1)
+    cache.load({"Hello!": {"response": "hey", "created_at": time.time()}})
+    rows, deleted = cache.take_pending()
+    # Unscoped keys from before normalization are moved to their scoped key
+    assert list(rows) == ["global:hello"] and deleted == ["Hello!"]
+    assert cache.take_pending() == ({}, [])
+
+    cache.put("global:bye", "see you")
+    rows, deleted = cache.take_pending()
+    assert list(rows) == ["global:bye"] and deleted == ["global:hello"]
@@ -0,0 +1,95 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from ai_client import AIQueueFull, AIScheduler, SingleFlight, call_with_retry
+
+
+def call(started, name):
+    async def func():
+        started.append(name)
+        return name
+    return func
+
+
+def test_starts_right_away_with_tokens():
+    async def scenario():
+        scheduler = AIScheduler()
+        future, position = scheduler.submit(1, call([], "a"))
+        assert position == 0
+        assert await future == "a"
+        assert scheduler.started == 1
+
+    asyncio.run(scenario())
+
+
+def test_rejects_past_max_queue():
+    async def scenario():
+        scheduler = AIScheduler(global_rate=0.001, global_burst=1, max_queue=2)
+        started = []
+        assert scheduler.submit(1, call(started, "a"))[1] == 0
+        assert scheduler.submit(1, call(started, "b"))[1] == 1
+        assert scheduler.submit(2, call(started, "c"))[1] == 2
+        with pytest.raises(AIQueueFull):
+            scheduler.submit(3, call(started, "d"))
+        assert len(scheduler) == 2
+        assert scheduler.rejected == 1
+
+    asyncio.run(scenario())
+
+
+def test_guilds_are_served_round_robin():
+    async def scenario():
+        scheduler = AIScheduler(global_rate=200, global_burst=1, guild_rate=200, guild_burst=3)
+        scheduler.global_bucket.tokens = 0
+        started = []
+        futures = [scheduler.submit(guild_id, call(started, name))[0]
+                   for guild_id, name in ((1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"))]
+        await asyncio.gather(*futures)
+        return started
+
+    assert asyncio.run(scenario()) == ["a1", "b1", "a2", "a3"]
+
+
+def test_cancelled_waiting_call_is_skipped():
+    async def scenario():
+        scheduler = AIScheduler(global_rate=200, global_burst=1)
+        scheduler.global_bucket.tokens = 0
+        started = []
+        first, _ = scheduler.submit(1, call(started, "a"))
+        second, _ = scheduler.submit(2, call(started, "b"))
+        first.cancel()
+        await second
+        return started, scheduler.started
+
+    assert asyncio.run(scenario()) == (["b"], 1)
+
+
+def test_rate_limited_calls_are_retried():
+    attempts = []
+
+    async def func():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise aiohttp.ClientResponseError(None, (), status=429)
+        return "ok"
+
+    assert asyncio.run(call_with_retry(func, max_retries=3, base_delay=0.001)) == "ok"
+    assert len(attempts) == 3
+
+
+def test_single_flight_shares_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        started = []
+
+        async def func():
+            started.append(1)
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        results = await asyncio.gather(*(flight.do("key", func) for _ in range(3)))
+        return results, len(started), flight.shared
+
+    assert asyncio.run(scenario()) == (["answer"] * 3, 1, 2)
@@ -0,0 +1,32 @@
+import check_blocking
+
+
+def test_repo_has_no_blocking_calls_in_coroutines(capsys):
+    assert check_blocking.main([]) == 0, capsys.readouterr().out
+
+
+def test_flags_blocking_calls_only_inside_coroutines():
+    source = """
+import time
+
+async def handler(storage):
+    time.sleep(1)
+    storage.load_settings()
+    storage.get_account(1, 2)  # blocking: ok
+
+    def later():
+        time.sleep(1)
+
+def sync():
+    time.sleep(1)
+"""
+    problems = check_blocking.check_source(source, "bot.py")
+    assert problems == [
+        "bot.py:5: time.sleep() blocks the event loop in handler()",
+        "bot.py:6: storage.load_settings() blocks the event loop in handler()",
+    ]
+
+
+def test_flags_sqlite_calls():
+    problems = check_blocking.check_source("async def f(self):\n    self.conn.execute('SELECT 1')\n")
+    assert problems == ["<source>:2: self.conn.execute() blocks the event loop in f()"]
@@ -0,0 +1,79 @@
+import asyncio
+
+from ledger import Ledger, rebuild, rebuild_balances
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def make_ledger(backend):
+    ledger = Ledger(backend)
+    ledger.open()
+    return ledger
+
+
+def test_transfer_moves_money_and_logs_both_sides(backend):
+    ledger = make_ledger(backend)
+    assert run(ledger.deposit("1", "a", 100))
+    assert run(ledger.transfer("1", "a", "b", 30))
+    assert run(ledger.balance("1", "a")) == 70
+    assert run(ledger.balance("1", "b")) == 30
+    assert rebuild_balances(backend.load_transactions()) == backend.load_currency()
+
+
+def test_transfer_refused_without_changes(backend):
+    ledger = make_ledger(backend)
+    run(ledger.deposit("1", "a", 10))
+    assert not run(ledger.transfer("1", "a", "b", 20))
+    assert not run(ledger.transfer("1", "a", "a", 5))
+    assert not run(ledger.transfer("1", "a", "b", 0))
+    assert not run(ledger.withdraw("1", "a", 11))
+    assert run(ledger.balance("1", "a")) == 10
+    assert run(ledger.balance("1", "b")) == 0
+    assert len(list(backend.load_transactions())) == 1
+
+
+def test_concurrent_transfers_keep_the_total(backend):
+    ledger = make_ledger(backend)
+    users = [str(user_id) for user_id in range(10)]
+
+    async def scenario():
+        for user_id in users:
+            await ledger.deposit("1", user_id, 100)
+        results = await asyncio.gather(*(
+            ledger.transfer("1", users[i % 10], users[(i * 3 + 1) % 10], 7) for i in range(200)
+        ))
+        return results
+
+    run(scenario())
+    accounts = backend.load_currency()["1"]
+    assert sum(account["miles"] for account in accounts.values()) == 1000
+    assert all(account["miles"] >= 0 for account in accounts.values())
+    assert rebuild_balances(backend.load_transactions()) == backend.load_currency()
+
+
+def test_claim_daily_respects_the_cooldown(backend):
+    ledger = make_ledger(backend)
+    assert run(ledger.claim_daily("1", "a", 50, 3600)) == (True, 0)
+    claimed, seconds_left = run(ledger.claim_daily("1", "a", 50, 3600))
+    assert not claimed and 0 < seconds_left <= 3600
+    assert run(ledger.balance("1", "a")) == 50
+
+
+def test_listeners_get_the_changed_accounts(backend):
+    ledger = make_ledger(backend)
+    seen = []
+    ledger.listeners.append(lambda guild_id, accounts: seen.append((guild_id, {u: a["miles"] for u, a in accounts.items()})))
+    run(ledger.deposit(1, "a", 5))
+    run(ledger.withdraw(1, "a", 10))
+    assert seen == [("1", {"a": 5})]
+
+
+def test_rebuild_fixes_balances_from_the_log(backend):
+    ledger = make_ledger(backend)
+    run(ledger.deposit("1", "a", 40))
+    run(ledger.transfer("1", "a", "b", 15))
+    backend.put_accounts([("1", "a", {"miles": 999, "last_flight": 0.0})])
+    assert rebuild(backend) == 1
+    assert backend.load_currency()["1"]["a"]["miles"] == 25
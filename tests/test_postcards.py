@@ -0,0 +1,23 @@
+from postcards import Mailboxes
+
+
+def test_shared_len_is_cached_until_this_process_writes(backend):
+    mailboxes = Mailboxes(backend, shared=True)
+    mailboxes.send("1", "hi")
+    assert len(mailboxes) == 1
+
+    # Another process sharing the storage: not seen until the cached value expires or we write
+    backend.add_postcards([("2", "hello")])
+    assert len(mailboxes) == 1
+    mailboxes.send("3", "hey")
+    assert len(mailboxes) == 3
+
+    mailboxes.remove("3", mailboxes.open("3"))
+    assert len(mailboxes) == 2
+
+
+def test_shared_len_is_refreshed_after_ttl(backend):
+    mailboxes = Mailboxes(backend, shared=True, shared_len_ttl=0)
+    assert len(mailboxes) == 0
+    backend.add_postcards([("2", "hello")])
+    assert len(mailboxes) == 1
@@ -0,0 +1,28 @@
+def add(amount):
+    def change(rows):
+        for user_data in rows.values():
+            user_data["xp"] += amount
+    return change
+
+
+def test_update_xp_applies_change_to_stored_values(backend):
+    backend.put_xp({"1": {"xp": 5, "level": 2}})
+    rows = backend.update_xp(["1", "2"], add(10))
+    assert rows == {"1": {"xp": 15, "level": 2}, "2": {"xp": 10, "level": 1}}
+    assert backend.load_xp() == rows
+
+
+def test_update_xp_twice_in_a_row_counts_each_award_once(backend):
+    # Like the bot: the returned rows become the in-memory XP, which then earns more
+    user_xp = backend.load_xp()
+    user_xp.update(backend.update_xp(["1"], add(10)))
+    user_xp["1"]["xp"] += 10
+    user_xp.update(backend.update_xp(["1"], add(10)))
+    assert backend.load_xp()["1"]["xp"] == 20
+    assert user_xp["1"]["xp"] == 20
+
+
+def test_load_xp_is_a_copy(backend):
+    backend.put_xp({"1": {"xp": 5, "level": 1}})
+    backend.load_xp()["1"]["xp"] = 100
+    assert backend.load_xp()["1"]["xp"] == 5
@@ -0,0 +1,68 @@
+import asyncio
+import sqlite3
+
+from xp import XPTracker, add_xp
+
+
+def test_add_xp_levels_up_at_100_per_level():
+    user_data = {"xp": 90, "level": 1}
+    add_xp(user_data, 15)
+    assert user_data == {"xp": 0, "level": 2}
+
+
+def test_flush_round_trip_counts_each_award_once(backend):
+    tracker = XPTracker(backend)
+
+    async def run():
+        tracker.award("1", 10)
+        await tracker.flush_async()
+        tracker.award("1", 10)
+        await tracker.flush_async()
+
+    asyncio.run(run())
+    assert backend.load_xp()["1"] == {"xp": 20, "level": 1}
+    assert tracker.user_xp["1"] == {"xp": 20, "level": 1}
+    assert tracker.board.top(1) == [("1", (1, 20))]
+
+
+def test_flush_keeps_xp_earned_elsewhere(backend):
+    tracker = XPTracker(backend)
+    tracker.load()
+    backend.put_xp({"1": {"xp": 30, "level": 1}})  # another process
+    tracker.award("1", 10)
+    tracker.flush()
+    assert backend.load_xp()["1"]["xp"] == 40
+    assert tracker.user_xp["1"]["xp"] == 40
+
+
+def test_failed_flush_keeps_pending_xp(backend):
+    tracker = XPTracker(backend)
+    update_xp = backend.update_xp
+
+    def locked(user_ids, change):
+        raise sqlite3.OperationalError("database is locked")
+
+    async def run():
+        tracker.award("1", 10)
+        backend.update_xp = locked
+        await tracker.flush_async()
+        assert tracker.pending == {"1": [10]}
+        tracker.award("1", 5)
+        backend.update_xp = update_xp
+        await tracker.flush_async()
+
+    asyncio.run(run())
+    assert tracker.pending == {}
+    assert backend.load_xp()["1"]["xp"] == 15
+
+
+def test_threshold_triggers_an_early_flush(backend):
+    tracker = XPTracker(backend, flush_threshold=2)
+
+    async def run():
+        tracker.award("1", 10)
+        tracker.award("2", 10)
+        await asyncio.gather(*tracker._tasks)
+
+    asyncio.run(run())
+    assert set(backend.load_xp()) == {"1", "2"}
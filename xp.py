@@ -0,0 +1,111 @@
+"""
+XP kept in memory and written to storage in batches.
+
+Awards update the in-memory XP (and the XP leaderboard) right away and are remembered as pending
+amounts. A flush replays the pending amounts onto the stored values in one storage call, so XP
+earned through other processes sharing the storage isn't overwritten. If the write fails, the
+amounts stay pending for the next flush.
+"""
+import asyncio
+
+from leaderboard import Leaderboard
+from storage import run_write
+
+
+def add_xp(user_data, xp_earned):
+    """Adds XP to a {"xp", "level"} entry and levels it up if it reached the next level."""
+    user_data["xp"] += xp_earned
+
+    # Check if the user leveled up
+    xp_to_next_level = user_data["level"] * 100  # Level up at 100 XP per level
+    if user_data["xp"] >= xp_to_next_level:
+        user_data["level"] += 1
+        user_data["xp"] = 0  # Reset XP after leveling up
+
+
+class XPTracker:
+    def __init__(self, storage, flush_threshold=50):
+        self.storage = storage
+        self.flush_threshold = flush_threshold
+        # Loaded by load() on first use
+        self.user_xp = None
+        # XP leaderboard ranked by (level, xp), updated along with user_xp
+        self.board = None
+        # user_id -> XP amounts earned since the last flush
+        self.pending = {}
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    def load(self):
+        """Loads XP and builds the XP leaderboard the first time either is needed."""
+        if self.user_xp is None:
+            self.user_xp = self.storage.load_xp()
+            self.board = Leaderboard({user_id: (data["level"], data["xp"]) for user_id, data in self.user_xp.items()})
+        return self.user_xp
+
+    def award(self, user_id, xp_earned):
+        self.load()
+        user_data = self.user_xp.setdefault(user_id, {"xp": 0, "level": 1})
+        add_xp(user_data, xp_earned)
+        self.board.update(user_id, (user_data["level"], user_data["xp"]))
+
+        # Flush early if a lot of changes piled up before the timer fires
+        self.pending.setdefault(user_id, []).append(xp_earned)
+        if len(self.pending) >= self.flush_threshold and not self._lock.locked():
+            task = asyncio.ensure_future(self.flush_async())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _take_pending(self):
+        pending, self.pending = self.pending, {}
+
+        def change(rows):
+            for user_id, amounts in pending.items():
+                for xp_earned in amounts:
+                    add_xp(rows[user_id], xp_earned)
+
+        return pending, change
+
+    def _restore(self, pending):
+        # Older amounts first, then anything awarded while the write was running
+        for user_id, amounts in pending.items():
+            self.pending[user_id] = amounts + self.pending.get(user_id, [])
+
+    def _apply(self, rows):
+        # The stored values include XP earned elsewhere, so keep those, plus anything awarded since
+        for user_id, stored in rows.items():
+            user_data = dict(stored)
+            for xp_earned in self.pending.get(user_id, []):
+                add_xp(user_data, xp_earned)
+            self.user_xp[user_id] = user_data
+            self.board.update(user_id, (user_data["level"], user_data["xp"]))
+
+    def flush(self):
+        """Writes pending XP right away; for shutdown, once the event loop has stopped."""
+        if not self.pending:
+            return
+        pending, change = self._take_pending()
+        try:
+            rows = self.storage.update_xp(list(pending), change)
+        except Exception:
+            self._restore(pending)
+            raise
+        self._apply(rows)
+
+    async def flush_async(self):
+        """
+        Writes pending XP. Backends whose writes can wait on locks (SQLite) are called from a worker
+        thread, so a busy database doesn't stall the event loop. One flush runs at a time.
+        """
+        async with self._lock:
+            if not self.pending:
+                return
+            pending, change = self._take_pending()
+            try:
+                rows = await run_write(self.storage, self.storage.update_xp, list(pending), change)
+            except Exception as e:
+                # Keep the XP for the next flush
+                self._restore(pending)
+                print(f"❌ Could not write XP, will retry: {str(e)}")
+                return
+            self._apply(rows)